@@ -0,0 +1,173 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import artparser
+
+
+def convert_svg(art, file):
+    import strokes2svg
+    strokes2svg.exportSvg(art, file)
+
+def convert_txt(art, file):
+    artparser.print_art(art, file)
+
+# output format -> (file extension, function writing a parsed file)
+CONVERTERS = {
+    'svg': ('.svg', convert_svg),
+    'txt': ('.txt', convert_txt),
+}
+
+
+def find_inputs(patterns):
+    '''
+    Expands the input arguments: directories are searched recursively for
+    .art files, anything else is taken as a glob pattern. Returns a list
+    of (input path, output path relative to the output directory).
+    '''
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for (dirpath, dirnames, filenames) in os.walk(pattern):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.lower().endswith('.art'):
+                        path = os.path.join(dirpath, name)
+                        inputs.append((path, os.path.relpath(path, pattern)))
+        else:
+            paths = sorted(glob.glob(pattern, recursive=True))
+            if not paths:
+                raise Exception('no input files match ' + repr(pattern))
+            for path in paths:
+                inputs.append((path, os.path.basename(path)))
+    return inputs
+
+
+def is_up_to_date(input_path, output_path):
+    try:
+        return os.stat(output_path).st_mtime_ns >= os.stat(input_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def convert_file(input_path, output_path, fmt):
+    '''
+    Converts one file; runs in the worker processes. Failures are returned
+    instead of raised, so they are reported with the file they belong to.
+    '''
+    result = {'input': input_path, 'output': output_path}
+    start = time.perf_counter()
+    try:
+        art = artparser.ArtParser(input_path)
+        parsed = time.perf_counter()
+        result['parse_seconds'] = parsed - start
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        # written to a temporary file first, so an interrupted run does not
+        # leave an output that looks up to date
+        temp_path = output_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                CONVERTERS[fmt][1](art, file)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        result['convert_seconds'] = time.perf_counter() - parsed
+        result['status'] = 'converted'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(patterns, output_dir, fmt='svg', workers=None, force=False):
+    '''
+    Converts all files given by patterns (see find_inputs) into output_dir
+    using a pool of workers processes. Outputs that are newer than their
+    input are skipped unless force is set. Returns the summary as a dict.
+    '''
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    extension = CONVERTERS[fmt][0]
+    results = []
+    outputs = {}
+    pending = []
+    for (input_path, relative) in find_inputs(patterns):
+        output_path = os.path.join(output_dir, os.path.splitext(relative)[0] + extension)
+        if output_path in outputs:
+            results.append({'input': input_path, 'output': output_path, 'status': 'failed',
+                            'error': 'same output as ' + outputs[output_path]})
+            continue
+        outputs[output_path] = input_path
+        if not force and is_up_to_date(input_path, output_path):
+            results.append({'input': input_path, 'output': output_path, 'status': 'skipped'})
+        else:
+            pending.append((input_path, output_path))
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(convert_file, input_path, output_path, fmt):
+                   (input_path, output_path)
+                   for (input_path, output_path) in pending}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception:
+                # the worker itself died, e.g. from running out of memory
+                (input_path, output_path) = futures[future]
+                results.append({'input': input_path, 'output': output_path,
+                                'status': 'failed', 'error': traceback.format_exc()})
+
+    results.sort(key=lambda result: result['input'])
+    counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+    for result in results:
+        counts[result['status']] += 1
+    return {
+        'format': fmt,
+        'workers': workers,
+        'seconds': time.perf_counter() - start,
+        'counts': counts,
+        'files': results,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='artbatch.py',
+        description='Converts many .art files in parallel.')
+    parser.add_argument('inputs', nargs='+', metavar='input',
+        help='.art file, glob pattern or directory to search for .art files')
+    parser.add_argument('-o', '--output', required=True,
+        help='directory to write the converted files to')
+    parser.add_argument('-f', '--format', choices=sorted(CONVERTERS), default='svg')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true',
+        help='also convert files whose output is up to date')
+    parser.add_argument('--summary',
+        help='where to write the JSON summary (default: summary.json in the output directory)')
+    args = parser.parse_args(argv[1:])
+
+    summary = run_batch(args.inputs, args.output, args.format, args.jobs, args.force)
+    summary_path = args.summary or os.path.join(args.output, 'summary.json')
+    os.makedirs(os.path.dirname(summary_path) or '.', exist_ok=True)
+    with open(summary_path, 'w') as file:
+        json.dump(summary, file, indent=1)
+
+    for result in summary['files']:
+        if result['status'] == 'failed':
+            print('failed: ' + result['input'], file=sys.stderr)
+            print(result['error'], file=sys.stderr)
+    counts = summary['counts']
+    print('%d converted, %d skipped, %d failed in %.1fs'
+          % (counts['converted'], counts['skipped'], counts['failed'], summary['seconds']))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,259 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from artparser import ArtParser, mischief_unpack
+
+# suffix of the cache entries, so unrelated files in the directory are left alone
+ENTRY_SUFFIX = '.unpacked'
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+class PayloadCache(object):
+    '''
+    Cache of decompressed .art payloads in a directory.
+    Usage: parsed = ArtParser(filename, cache=PayloadCache(directory))
+
+    The entries are keyed on a hash of the compressed payload, or with
+    key='stat', on the path, modification time and size of the file, which
+    avoids hashing the payload but misses renamed and copied files.
+    Cached payloads are mapped into memory instead of being read.
+
+    When the entries take more than max_bytes, the least recently used
+    ones are deleted. Use is tracked through the modification times of
+    the entries.
+    '''
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, key='hash'):
+        if key not in ('hash', 'stat'):
+            raise Exception('unknown cache key type: ' + repr(key))
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.key = key
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_key(self, fname, payload):
+        if self.key == 'stat':
+            st = os.stat(fname)
+            ident = '%s\0%d\0%d' % (os.path.abspath(fname), st.st_mtime_ns, st.st_size)
+            return hashlib.blake2b(ident.encode('utf-8'), digest_size=20).hexdigest()
+        return hashlib.blake2b(payload, digest_size=20).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def unpack(self, fname, payload, progress=None):
+        '''
+        Returns the decompressed payload of the file fname, whose compressed
+        payload is given. This is either a mapped cache entry or the
+        output of mischief_unpack, which is then added to the cache.
+        progress is passed on to mischief_unpack, or called once with the
+        full length for a cache entry.
+        '''
+        path = self.entry_path(self.entry_key(fname, payload))
+        (out_length,) = struct.unpack_from('I', payload, 0)
+        data = self.load(path, out_length)
+        if data is None:
+            data = mischief_unpack(payload, progress=progress)
+            self.store(path, data)
+        elif progress is not None:
+            progress(out_length, out_length)
+        return data
+
+    def load(self, path, out_length):
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with file:
+            if os.fstat(file.fileno()).st_size != out_length:
+                # left over by a different version, or otherwise damaged
+                return None
+            if out_length == 0:
+                data = bytearray()
+            else:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted by another process in the meantime, the mapping stays valid
+            pass
+        return data
+
+    def store(self, path, data):
+        # written to a temporary file first, so that readers never see
+        # a partial entry
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        '''
+        Deletes the least recently used entries until the rest fit into
+        max_bytes.
+        '''
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(ENTRY_SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        '''
+        Deletes all entries.
+        '''
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(ENTRY_SUFFIX):
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+
+DEFAULT_DOCUMENT_BYTES = 1 << 30
+
+# rough sizes of the Python objects of a parsed document, used to estimate
+# its footprint: an action dict, and a point dict with its three floats
+ACTION_BYTES = 400
+POINT_DICT_BYTES = 260
+
+
+def array_bytes(values):
+    '''
+    Returns the size of the items of an array.array.
+    '''
+    return len(values) * values.itemsize
+
+
+def estimate_footprint(art):
+    '''
+    Estimates the memory taken by a parsed document from the size of its
+    decompressed payload, its images and its actions and points.
+    '''
+    total = 0
+    if isinstance(art.data, bytearray):
+        # a mapped cache entry is backed by the file, so it is not counted
+        total += len(art.data)
+    for image in art.images or ():
+        total += len(image['raw'])
+    if art.lazy_actions:
+        # the offset, layer and id of each action, and the layer index
+        for values in (art.action_offsets, art.action_layers, art.action_ids,
+                       art.pen_state_index):
+            total += array_bytes(values)
+        for indices in art.layer_index.values():
+            total += array_bytes(indices)
+        return total
+    if art.points is not None:
+        total += art.points.nbytes
+    for action in art.actions or ():
+        total += ACTION_BYTES
+        if art.points is None and 'points' in action:
+            total += POINT_DICT_BYTES * len(action['points'])
+    return total
+
+
+class ArtCache(object):
+    '''
+    Cache of parsed documents for long-running processes.
+    Usage: parsed = cache.get(filename)
+
+    The documents are keyed on the path, modification time and size of
+    the file, and the keyword arguments for ArtParser. They are shared
+    between all callers, so they must not be modified. When their
+    estimated footprint (see estimate_footprint) exceeds max_bytes, the
+    least recently used ones are dropped.
+
+    get is thread safe. Concurrent calls for a document that is not
+    cached yet wait for a single parse instead of each parsing the file.
+    '''
+    def __init__(self, max_bytes=DEFAULT_DOCUMENT_BYTES, parser=ArtParser):
+        self.max_bytes = max_bytes
+        self.parser = parser
+        self.total_bytes = 0
+        # key -> (document, footprint), least recently used first
+        self.documents = OrderedDict()
+        # key -> Future of the document being parsed
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, fname, **kwargs):
+        if kwargs.get('stream_actions'):
+            raise Exception('streamed documents can only be iterated over once, they cannot be cached')
+        path = os.path.abspath(fname)
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size, tuple(sorted(kwargs.items())))
+        with self.lock:
+            if key in self.documents:
+                self.documents.move_to_end(key)
+                return self.documents[key][0]
+            future = self.pending.get(key)
+            if future is None:
+                future = Future()
+                self.pending[key] = future
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+
+        try:
+            art = self.parser(fname, **kwargs)
+        except BaseException as e:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            raise
+        footprint = estimate_footprint(art)
+        with self.lock:
+            del self.pending[key]
+            self.drop_stale(key)
+            if footprint <= self.max_bytes:
+                self.documents[key] = (art, footprint)
+                self.total_bytes += footprint
+                self.evict()
+        future.set_result(art)
+        return art
+
+    def drop_stale(self, key):
+        # older versions of a file that has changed are not going to be used again
+        for other in [k for k in self.documents if k[0] == key[0] and k[1:3] != key[1:3]]:
+            self.total_bytes -= self.documents.pop(other)[1]
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            (_, (_, footprint)) = self.documents.popitem(last=False)
+            self.total_bytes -= footprint
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+            self.total_bytes = 0
@@ -1,5 +1,18 @@
+import asyncio
+import heapq
+import math
+import mmap
+import os
 import struct
 import sys
+import time
+import weakref
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class MRUList():
     '''
@@ -30,18 +43,29 @@ class BinaryArithmeticDecoder():
     A function get_raw_bit, that decodes 0 and 1 with equal probability
     and incurs less rounding errors than get_bit with a threshold of 0x400
     is also provided.
+
+    The input can be any buffer that supports indexing (bytes, memoryview,
+    mmap, ...); it is read in place. The stream is implicitly followed by
+    four zero bytes, reading beyond those is an error.
     '''
     center_threshold = 0x400
+    padding = 4
 
-    __slots__ = ['scale', 'value', 'input']
+    __slots__ = ['scale', 'value', 'input', 'position']
     def __init__(self, byte_input):
         self.scale = 0xFFFFFFFF
-        (self.value,) = struct.unpack('>I', byte_input[0:4])
-        self.input = iter(byte_input[4:] + bytearray([0,0,0,0]))
+        (self.value,) = struct.unpack_from('>I', byte_input, 0)
+        self.input = byte_input
+        self.position = 4
     def _renormalize(self):
         if self.scale < 0x01000000:
             self.scale <<= 8
-            self.value = (self.value << 8) | next(self.input)
+            self.value <<= 8
+            if self.position < len(self.input):
+                self.value |= self.input[self.position]
+            elif self.position >= len(self.input) + self.padding:
+                raise Exception('compressed data ends prematurely')
+            self.position += 1
     def get_bit(self, threshold):
         self._renormalize()
         scaled_threshold = ((self.scale >> 0x0b) * threshold)
@@ -151,6 +175,13 @@ class LSBFirstGetter():
             bitnum += 1
         return value
 
+class DiscardedOutputError(Exception):
+    '''
+    Raised when a back-reference reaches output that LZ77Output.discard
+    has dropped.
+    '''
+
+
 class LZ77Output():
     '''
     Generic LZ77 output handling.
@@ -158,9 +189,14 @@ class LZ77Output():
     This class manages an output buffer, and is able to append single bytes
     or copy from earlier parts of the buffer, given a distance to the end.
     A distance of 0 means the last byte already stored.
+
+    The start of the buffer can be dropped with discard to bound memory
+    use. Positions stay counted from the start of the whole output; using
+    a dropped byte as copy source raises an exception.
     '''
     def __init__(self):
         self.decoded = bytearray()
+        self.discarded = 0
 
     # LZ77 literal code
     def literal_byte(self, byte):
@@ -168,24 +204,52 @@ class LZ77Output():
 
     # LZ77 distance use/copying
     def copy_bytes(self, distance, count):
-        for _ in range(count):
-            self.decoded.append(self.get_earlier_byte(distance))
+        # Behaves like appending get_earlier_byte(distance) count times,
+        # i.e. as if the buffer was preceded by an infinite run of zeros.
+        decoded = self.decoded
+        start = len(decoded) - distance - 1
+        if start < 0:
+            zeros = min(-start - self.discarded, count)
+            if zeros < count and self.discarded:
+                raise DiscardedOutputError('reference to discarded output')
+            decoded.extend(bytes(zeros))
+            count -= zeros
+            start = 0
+        period = distance + 1
+        if count <= period:
+            decoded += decoded[start:start+count]
+        else:
+            # overlapping copy: the source repeats every distance+1 bytes
+            repeats, rest = divmod(count, period)
+            pattern = decoded[start:start+period]
+            decoded += pattern * repeats + pattern[:rest]
 
     # buffer inspection
     def get_earlier_byte(self, distance):
-        if distance >= len(self.decoded):
+        if distance >= self.get_length():
             return 0
+        elif distance >= len(self.decoded):
+            raise DiscardedOutputError('reference to discarded output')
         else:
             return self.decoded[-distance-1]
 
     def get_byte_in_dword(self):
-        return len(self.decoded) & 3
+        return self.get_length() & 3
 
     def get_data(self):
         return self.decoded
 
     def get_length(self):
-        return len(self.decoded)
+        return self.discarded + len(self.decoded)
+
+    def discard(self, keep):
+        '''
+        Drops all but the last keep bytes from the buffer.
+        '''
+        excess = len(self.decoded) - keep
+        if excess > 0:
+            del self.decoded[:excess]
+            self.discarded += excess
 
 class LiteralGetter():
     '''
@@ -311,12 +375,14 @@ class State():
         self.get_kind_1_nontrivial = [AdaptiveBitGetter(decoder) for _ in range(4)]
         
 
-def mischief_unpack(byte_input):
+def mischief_unpack_reference(byte_input):
     '''
-    this function unpacks bytes and returns an unpacked byte array
+    Unpacks bytes using the model classes above and returns an unpacked
+    byte array. This is the readable description of the format; it is
+    slow and mostly useful for cross-checking mischief_unpack.
     '''
-    (out_length,) = struct.unpack('I', byte_input[0:4])
-    decoder = BinaryArithmeticDecoder(byte_input[5:])
+    (out_length,) = struct.unpack_from('I', byte_input, 0)
+    decoder = BinaryArithmeticDecoder(memoryview(byte_input)[5:])
     output = LZ77Output()
 
     # literal_getters is indexed by the top 3 bits of the previous byte
@@ -378,49 +444,530 @@ def mischief_unpack(byte_input):
     return output.get_data()
 
 
+# Layout of the flat context list used by mischief_unpack. Every adaptive
+# context of the reference models above gets one slot in a single list
+# (a list rather than an array('H'), since the decoding loop is measurably
+# faster when it does not have to box and unbox the thresholds).
+# Bit trees (MSBFirstGetter, LSBFirstGetter and the literal layers) use node
+# numbers 1..2**bits-1, so a tree of n bits takes 2**n slots (slot 0 unused).
+
+# 8 literal models (top 3 bits of the previous byte), each having three
+# trees of 256 slots: no context, context bit zero and context bit one.
+_LITERAL_BASE = 0
+_LITERAL_SIZE = 3 * 0x100
+
+# Each State has 4 is_reference_code contexts, a 4-context UnaryGetter
+# for the reference kind and 4 get_kind_1_nontrivial contexts.
+_STATE_BASE = _LITERAL_BASE + 8 * _LITERAL_SIZE
+_STATE_SIZE = 12
+_STATE_KIND = 4
+_STATE_KIND_1_NONTRIVIAL = 8
+
+def _build_state_graph():
+    '''
+    Lays out the states built by mischief_unpack_reference. States are
+    identified by the index of their first context. Returns a dict giving
+    the state to switch to after a literal, and the state lists (indexed by
+    last_was_reference) used after a new distance reference, a reused
+    distance reference and a trivial one byte copy.
+    '''
+    after_literal = {}
+    def state(after=None):
+        new_state = _STATE_BASE + _STATE_SIZE * len(after_literal)
+        after_literal[new_state] = new_state if after is None else after
+        return new_state
+
+    base_state = state()
+    intermediate_after_new_distance = state(state(base_state))
+    intermediate_after_reused_distance = state(state(base_state))
+    intermediate_after_trivial_copy = state(state(base_state))
+    after_new_distance = [state(intermediate_after_new_distance),
+                          state(intermediate_after_new_distance)]
+    common_after_reuse_or_trivial_after_ref = \
+        state(intermediate_after_reused_distance)
+    after_reused_distance = [state(intermediate_after_reused_distance),
+                             common_after_reuse_or_trivial_after_ref]
+    after_trivial_copy = [state(intermediate_after_trivial_copy),
+                          common_after_reuse_or_trivial_after_ref]
+    return (after_literal, after_new_distance,
+            after_reused_distance, after_trivial_copy)
+
+(_STATE_AFTER_LITERAL, _STATES_AFTER_NEW_DISTANCE,
+ _STATES_AFTER_REUSED_DISTANCE, _STATES_AFTER_TRIVIAL_COPY) = _build_state_graph()
+_STATE_COUNT = len(_STATE_AFTER_LITERAL)
+
+# LengthGetter: 2 range contexts, the shared 8 bit tree for 16..271 and
+# 4 subcontexts of two 3 bit trees for 0..7 and 8..15.
+_LENGTH_RANGE = 0
+_LENGTH_LONG = 2
+_LENGTH_SHORT = _LENGTH_LONG + 0x100
+_LENGTH_SIZE = _LENGTH_SHORT + 4 * 2 * 8
+_NEW_LENGTH_BASE = _STATE_BASE + _STATE_COUNT * _STATE_SIZE
+_REUSED_LENGTH_BASE = _NEW_LENGTH_BASE + _LENGTH_SIZE
+
+# DistanceGetter: 4 coarse 6 bit trees, two LSB-first trees for every
+# medium distance range of 1..5 bits and the 4 bit tree for the low bits
+# of long distances.
+_DISTANCE_COARSE_BASE = _REUSED_LENGTH_BASE + _LENGTH_SIZE
+_DISTANCE_MEDIUM_BASES = []
+_next_base = _DISTANCE_COARSE_BASE + 4 * 0x40
+for _bits in range(1, 6):
+    _DISTANCE_MEDIUM_BASES.append((_next_base, _next_base + (1 << _bits)))
+    _next_base += 2 << _bits
+_DISTANCE_LONG_LOW_BASE = _next_base
+_CONTEXT_COUNT = _DISTANCE_LONG_LOW_BASE + 0x10
+del _next_base, _bits
+
+# AdaptiveBitGetter's threshold update, tabulated for all thresholds
+_THRESHOLD_AFTER_ZERO = [t - ((t + 0x1f) >> 5) + 0x40 for t in range(0x800)]
+_THRESHOLD_AFTER_ONE = [t - (t >> 5) for t in range(0x800)]
+
+
+# With a deadline or progress callback, MischiefUnpacker.step decodes
+# pieces of this many bytes of output at a time
+STEP_PIECE_SIZE = 0x4000
+
+
+class MischiefUnpacker():
+    '''
+    Incremental decoder for the mischief compression format.
+
+    It decodes the same format as mischief_unpack_reference, but keeps all
+    adaptive contexts in one flat list and has the arithmetic decoder and
+    the models inlined into the decoding loop. Like BinaryArithmeticDecoder,
+    it reads byte_input in place, so a memoryview or mmap can be passed
+    without copying the compressed data.
+
+    Output is produced by calling step, which can be asked to stop after
+    a number of bytes or at a deadline; the decoder state is kept in the
+    instance between calls. The output ends up in self.output, an
+    LZ77Output. If progress is given, step calls it with the output
+    length so far and the total output length as it goes.
+    '''
+    def __init__(self, byte_input, progress=None):
+        (self.out_length,) = struct.unpack_from('I', byte_input, 0)
+        (self.value,) = struct.unpack_from('>I', byte_input, 5)
+        self.input = byte_input
+        self.position = 9
+        self.scale = 0xFFFFFFFF
+
+        self.output = LZ77Output()
+        self.contexts = [BinaryArithmeticDecoder.center_threshold] * _CONTEXT_COUNT
+        self.distance_history = [0] * 4
+        self.state = _STATE_BASE
+        self.last_was_reference = False
+        self.match_byte = -1 # byte following the last copy, -1 if unused
+        self.progress = progress
+
+    def is_finished(self):
+        return self.output.get_length() >= self.out_length
+
+    def step(self, max_bytes=None, deadline=None):
+        '''
+        Decodes at least max_bytes more bytes of output (all of it if
+        max_bytes is None), unless the end of the output is reached first.
+        A final copy may overshoot max_bytes by up to 271 bytes.
+
+        If deadline (a time.monotonic() value) is given, decoding also
+        stops once it has passed. The clock is checked every
+        STEP_PIECE_SIZE bytes of output, and after those, progress is
+        called if set. Returns whether all output has been decoded.
+        '''
+        if deadline is None and self.progress is None:
+            self.decode(max_bytes)
+            return self.is_finished()
+
+        end = None if max_bytes is None else self.output.get_length() + max_bytes
+        while not self.is_finished():
+            length = self.output.get_length()
+            if end is not None and length >= end:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            self.decode(STEP_PIECE_SIZE if end is None else min(STEP_PIECE_SIZE, end - length))
+            if self.progress is not None:
+                self.progress(self.output.get_length(), self.out_length)
+        return self.is_finished()
+
+    def decode(self, max_bytes=None):
+        '''
+        Does the work of step, without looking at the clock.
+        '''
+        data = self.input
+        in_end = len(data)
+        # reading is allowed into the implicit zero bytes after the data
+        in_limit = in_end + BinaryArithmeticDecoder.padding
+        in_pos = self.position
+        scale = self.scale
+        value = self.value
+        out_length = self.out_length
+
+        def refill(scale, value, in_pos):
+            # shifts the next input byte into the arithmetic decoder; the
+            # callers check scale < 0x01000000 first, so the common case
+            # of no refill doesn't pay for a call
+            value <<= 8
+            if in_pos < in_end:
+                value |= data[in_pos]
+            elif in_pos >= in_limit:
+                raise Exception('compressed data ends prematurely')
+            return (scale << 8, value, in_pos + 1)
+
+        output = self.output
+        decoded = output.decoded
+        contexts = self.contexts
+        after_zero = _THRESHOLD_AFTER_ZERO
+        after_one = _THRESHOLD_AFTER_ONE
+        distance_history = self.distance_history
+        after_literal = _STATE_AFTER_LITERAL
+
+        last_was_reference = self.last_was_reference
+        match_byte = self.match_byte
+        state = self.state
+        length = output.get_length()
+        target = out_length
+        if max_bytes is not None:
+            target = min(out_length, length + max_bytes)
+
+        while length < target:
+            # is_reference_code
+            if scale < 0x01000000:
+                (scale, value, in_pos) = refill(scale, value, in_pos)
+            ctx = state + (length & 3)
+            threshold = contexts[ctx]
+            bound = (scale >> 11) * threshold
+            if value < bound:
+                scale = bound
+                contexts[ctx] = after_zero[threshold]
+
+                # LZ77 literal: add a single (new) byte to the output
+                base = _LITERAL_BASE + (decoded[-1] >> 5 if length else 0) * _LITERAL_SIZE
+                node = 1
+                if match_byte >= 0:
+                    # decode using the context byte until the first mismatch
+                    while node < 0x100:
+                        ref_bit = (match_byte >> 7) & 1
+                        match_byte <<= 1
+                        if scale < 0x01000000:
+                            (scale, value, in_pos) = refill(scale, value, in_pos)
+                        ctx = base + 0x100 + (ref_bit << 8) + node
+                        threshold = contexts[ctx]
+                        bound = (scale >> 11) * threshold
+                        if value < bound:
+                            scale = bound
+                            contexts[ctx] = after_zero[threshold]
+                            node <<= 1
+                            if ref_bit:
+                                break
+                        else:
+                            value -= bound
+                            scale -= bound
+                            contexts[ctx] = after_one[threshold]
+                            node = (node << 1) | 1
+                            if not ref_bit:
+                                break
+                    match_byte = -1
+                while node < 0x100:
+                    if scale < 0x01000000:
+                        (scale, value, in_pos) = refill(scale, value, in_pos)
+                    ctx = base + node
+                    threshold = contexts[ctx]
+                    bound = (scale >> 11) * threshold
+                    if value < bound:
+                        scale = bound
+                        contexts[ctx] = after_zero[threshold]
+                        node <<= 1
+                    else:
+                        value -= bound
+                        scale -= bound
+                        contexts[ctx] = after_one[threshold]
+                        node = (node << 1) | 1
+                decoded.append(node & 0xFF)
+                length += 1
+                state = after_literal[state]
+                last_was_reference = False
+                continue
+
+            value -= bound
+            scale -= bound
+            contexts[ctx] = after_one[threshold]
+
+            # LZ77 reference: copy a part of previous output
+            reference_kind = 0
+            while reference_kind < 4:
+                if scale < 0x01000000:
+                    (scale, value, in_pos) = refill(scale, value, in_pos)
+                ctx = state + _STATE_KIND + reference_kind
+                threshold = contexts[ctx]
+                bound = (scale >> 11) * threshold
+                if value < bound:
+                    scale = bound
+                    contexts[ctx] = after_zero[threshold]
+                    break
+                value -= bound
+                scale -= bound
+                contexts[ctx] = after_one[threshold]
+                reference_kind += 1
+
+            length_base = _REUSED_LENGTH_BASE
+            if reference_kind == 1:
+                if scale < 0x01000000:
+                    (scale, value, in_pos) = refill(scale, value, in_pos)
+                ctx = state + _STATE_KIND_1_NONTRIVIAL + (length & 3)
+                threshold = contexts[ctx]
+                bound = (scale >> 11) * threshold
+                if value < bound:
+                    scale = bound
+                    contexts[ctx] = after_zero[threshold]
+                    length_base = -1
+                else:
+                    value -= bound
+                    scale -= bound
+                    contexts[ctx] = after_one[threshold]
+            elif reference_kind == 0:
+                length_base = _NEW_LENGTH_BASE
+
+            if length_base < 0:
+                # trivial one byte copy using the most recent distance
+                copy_len = 1
+                distance = distance_history[0]
+                state = _STATES_AFTER_TRIVIAL_COPY[last_was_reference]
+            else:
+                # copy length: range selection, then a bit tree
+                if scale < 0x01000000:
+                    (scale, value, in_pos) = refill(scale, value, in_pos)
+                ctx = length_base + _LENGTH_RANGE
+                threshold = contexts[ctx]
+                bound = (scale >> 11) * threshold
+                if value < bound:
+                    scale = bound
+                    contexts[ctx] = after_zero[threshold]
+                    base = length_base + _LENGTH_SHORT + (length & 3) * 16
+                    tree_end = 8
+                    copy_len = 2 - tree_end
+                else:
+                    value -= bound
+                    scale -= bound
+                    contexts[ctx] = after_one[threshold]
+                    if scale < 0x01000000:
+                        (scale, value, in_pos) = refill(scale, value, in_pos)
+                    ctx += 1
+                    threshold = contexts[ctx]
+                    bound = (scale >> 11) * threshold
+                    if value < bound:
+                        scale = bound
+                        contexts[ctx] = after_zero[threshold]
+                        base = length_base + _LENGTH_SHORT + (length & 3) * 16 + 8
+                        tree_end = 8
+                        copy_len = 2 + 8 - tree_end
+                    else:
+                        value -= bound
+                        scale -= bound
+                        contexts[ctx] = after_one[threshold]
+                        base = length_base + _LENGTH_LONG
+                        tree_end = 0x100
+                        copy_len = 2 + 16 - tree_end
+                node = 1
+                while node < tree_end:
+                    if scale < 0x01000000:
+                        (scale, value, in_pos) = refill(scale, value, in_pos)
+                    ctx = base + node
+                    threshold = contexts[ctx]
+                    bound = (scale >> 11) * threshold
+                    if value < bound:
+                        scale = bound
+                        contexts[ctx] = after_zero[threshold]
+                        node <<= 1
+                    else:
+                        value -= bound
+                        scale -= bound
+                        contexts[ctx] = after_one[threshold]
+                        node = (node << 1) | 1
+                copy_len += node
+
+                if reference_kind == 0:
+                    # explicitly coded distance, starting with the coarse range
+                    base = _DISTANCE_COARSE_BASE + min(copy_len - 2, 3) * 0x40
+                    node = 1
+                    while node < 0x40:
+                        if scale < 0x01000000:
+                            (scale, value, in_pos) = refill(scale, value, in_pos)
+                        ctx = base + node
+                        threshold = contexts[ctx]
+                        bound = (scale >> 11) * threshold
+                        if value < bound:
+                            scale = bound
+                            contexts[ctx] = after_zero[threshold]
+                            node <<= 1
+                        else:
+                            value -= bound
+                            scale -= bound
+                            contexts[ctx] = after_one[threshold]
+                            node = (node << 1) | 1
+                    coarse_distance = node - 0x40
+                    if coarse_distance < 4:
+                        distance = coarse_distance
+                    else:
+                        next_to_MSB = coarse_distance & 1
+                        extra_bits_to_fetch = 1 + ((coarse_distance - 4) >> 1)
+                        distance = (2 | next_to_MSB) << extra_bits_to_fetch
+                        if extra_bits_to_fetch < 6:
+                            base = _DISTANCE_MEDIUM_BASES[extra_bits_to_fetch - 1][next_to_MSB]
+                            low_bits = extra_bits_to_fetch
+                        else:
+                            for bitnum in range(extra_bits_to_fetch - 1, 3, -1):
+                                if scale < 0x01000000:
+                                    (scale, value, in_pos) = refill(scale, value, in_pos)
+                                scale >>= 1
+                                if value >= scale:
+                                    value -= scale
+                                    distance |= 1 << bitnum
+                            base = _DISTANCE_LONG_LOW_BASE
+                            low_bits = 4
+                        # LSB first bit tree; node keeps the bits read so far
+                        node = 0
+                        for bitnum in range(low_bits):
+                            if scale < 0x01000000:
+                                (scale, value, in_pos) = refill(scale, value, in_pos)
+                            ctx = base + (1 << bitnum) + node
+                            threshold = contexts[ctx]
+                            bound = (scale >> 11) * threshold
+                            if value < bound:
+                                scale = bound
+                                contexts[ctx] = after_zero[threshold]
+                            else:
+                                value -= bound
+                                scale -= bound
+                                contexts[ctx] = after_one[threshold]
+                                node |= 1 << bitnum
+                        distance |= node
+                    distance_history[1:] = distance_history[0:-1]
+                    distance_history[0] = distance
+                    state = _STATES_AFTER_NEW_DISTANCE[last_was_reference]
+                else:
+                    index = reference_kind - 1
+                    (distance_history[0], distance_history[1:index+1]) = \
+                        (distance_history[index], distance_history[0:index])
+                    distance = distance_history[0]
+                    state = _STATES_AFTER_REUSED_DISTANCE[last_was_reference]
+
+            if length + copy_len > out_length:
+                raise Exception("Unpacking generates excess data")
+            output.copy_bytes(distance, copy_len)
+            length += copy_len
+            # first non-copied byte
+            match_byte = decoded[-distance-1] if distance < length else 0
+            last_was_reference = True
+
+        self.position = in_pos
+        self.scale = scale
+        self.value = value
+        self.state = state
+        self.last_was_reference = last_was_reference
+        self.match_byte = match_byte
+
+
+# How many bytes of output mischief_unpack_stream keeps around for
+# back-references by default. The format itself has no window limit.
+DEFAULT_STREAM_WINDOW = 1 << 24
+
+
+def mischief_unpack(byte_input, progress=None):
+    '''
+    this function unpacks bytes and returns an unpacked byte array
+
+    progress is called with the output length so far and the total
+    output length while unpacking, see MischiefUnpacker.
+    '''
+    unpacker = MischiefUnpacker(byte_input, progress)
+    unpacker.step()
+    return unpacker.output.get_data()
+
+
+def mischief_unpack_stream(byte_input, chunk_size=0x10000,
+                           window=DEFAULT_STREAM_WINDOW, progress=None):
+    '''
+    Unpacks bytes like mischief_unpack, but returns an iterator yielding
+    the output in chunks of about chunk_size bytes as soon as they are
+    decoded.
+
+    Only the last window bytes (at least one) of output are kept for
+    back-references; a reference reaching further back raises
+    DiscardedOutputError. Pass window=None to keep the whole output.
+
+    progress is called as the output is decoded, see MischiefUnpacker.
+    '''
+    if window is not None and window < 1:
+        raise ValueError('window must be at least 1, or None')
+    return _unpack_stream_chunks(byte_input, chunk_size, window, progress)
+
+def _unpack_stream_chunks(byte_input, chunk_size, window, progress):
+    unpacker = MischiefUnpacker(byte_input, progress)
+    output = unpacker.output
+    while not unpacker.is_finished():
+        produced = output.get_length()
+        try:
+            unpacker.step(chunk_size)
+        except DiscardedOutputError:
+            raise DiscardedOutputError(
+                'back-reference reaches further back than the window of %d bytes '
+                'of output kept by mischief_unpack_stream; a larger window '
+                '(or None) is needed for this data' % window) from None
+        produced = output.get_length() - produced
+        yield bytes(output.decoded[len(output.decoded) - produced:])
+        if window is not None:
+            output.discard(window)
+
+
 ART_MAGICS = set([b'\xc5\xb3\x8b\xe9', b'\xc5\xb3\x8b\xe7'])
 
 def read_byte(data, pos):
     return (data[pos], pos+1)
 
 
+INT = struct.Struct('<I')
+FLOAT = struct.Struct('<f')
+
 def read_int(data, pos):
-    (val,) = struct.unpack('I', data[pos:pos+4])
+    (val,) = INT.unpack_from(data, pos)
     return (val, pos+4)
 
 
 def read_int_array(data, pos, count):
-    val = list(struct.unpack('%dI'%count,
-                             data[pos:pos+4*count]))
+    val = list(struct.unpack_from('<%dI'%count, data, pos))
     return (val, pos+4*count)
 
 
 def read_float(data, pos):
-    (val,) = struct.unpack('f', data[pos:pos+4])
+    (val,) = FLOAT.unpack_from(data, pos)
     return (val, pos+4)
 
 
 def read_float_array(data, pos, n):
-    floats = list(struct.unpack('%df'%n,
-                                data[pos:pos+4*n]))
+    floats = list(struct.unpack_from('<%df'%n, data, pos))
     return (floats, pos+4*n)
 
 
+def matrix_rows(floats, n, m):
+    return [list(floats[i*n:i*n+n]) for i in range(0,m)]
+
+
 def read_float_matrix(data, pos, n, m):
-    floats = list(struct.unpack('%df'%(n*m),
-                                data[pos:pos+4*n*m]))
-    return ([floats[i*n:i*n+n] for i in range(0,m)],
-            pos+4*n*m)
+    floats = struct.unpack_from('<%df'%(n*m), data, pos)
+    return (matrix_rows(floats, n, m), pos+4*n*m)
 
 
 def read_bytes(data, pos, length):
     return (data[pos:pos+length], pos+length)
 
 
+def decode_string(val):
+    return val.split(b'\x00', 1)[0].decode('utf-8')
+
+
 def read_string(data, pos, length):
     val = data[pos:pos+length]
-    return (val.split(b'\x00', 1)[0].decode('utf-8'),
-            pos+length)
+    return (decode_string(val), pos+length)
 
 
 def read_color(data, pos):
@@ -428,28 +975,30 @@ def read_color(data, pos):
     return (val, pos+3)
 
 
+PEN_INFO = struct.Struct('<I3B5fI')
+
 def read_pen_info(data, pos):
+    v = PEN_INFO.unpack_from(data, pos)
     val = {}
-    (val['type'], pos) = read_int(data, pos)
-    (val['color'], pos) = read_color(data, pos)
-    (val['noise'], pos) = read_float(data, pos)
-    (val['size'], pos) = read_float(data, pos)
-    (val['size_min'], pos) = read_float(data, pos)
-    (val['opacity'], pos) = read_float(data, pos)
-    (val['opacity_min'], pos) = read_float(data, pos)
-    (val['is_eraser'], pos) = read_int(data, pos)
-    return (val, pos)
+    val['type'] = v[0]
+    val['color'] = v[1:4]
+    (val['noise'], val['size'], val['size_min'],
+     val['opacity'], val['opacity_min'], val['is_eraser']) = v[4:10]
+    return (val, pos+PEN_INFO.size)
+
 
+LAYER_INFO = struct.Struct('<If256sI16ff')
 
 def read_layer_info(data, pos):
+    v = LAYER_INFO.unpack_from(data, pos)
     val = {}
-    (val['visible'], pos) = read_int(data, pos)
-    (val['opacity'], pos) = read_float(data, pos)
-    (val['name'], pos) = read_string(data, pos, 256)
-    (val['action_count'], pos) = read_int(data, pos)
-    (val['matrix'], pos) = read_float_matrix(data, pos, 4, 4)
-    (val['zoom'], pos) = read_float(data, pos)
-    return (val, pos)
+    val['visible'] = v[0]
+    val['opacity'] = v[1]
+    val['name'] = decode_string(v[2])
+    val['action_count'] = v[3]
+    val['matrix'] = matrix_rows(v[4:20], 4, 4)
+    val['zoom'] = v[20]
+    return (val, pos+LAYER_INFO.size)
 
 
 def read_image(data, pos):
@@ -459,154 +1008,683 @@ def read_image(data, pos):
     (val['raw'], pos) = read_bytes(data, pos, size)
     return (val, pos)
 
-def read_polyline(data, pos, count):
-    val = {}
-    points = []
-    for _ in range(count):
-        ([x, y, p], pos) = read_float_array(data, pos, 3)
-        points.append({ 'x': x, 'y': y, 'p': p })
-    return (points, pos)
+# Strokes with fewer points are decoded without numpy, as setting up
+# the arrays costs more than the plain loop for them.
+VECTORIZED_STROKE_MIN_POINTS = 32
 
-def read_action(data, pos):
-    val = {}
-    start = pos
-    (val['layer'], pos) = read_int(data, pos)
-    (val['action_id'], pos) = read_int(data, pos)
-
-    if val['action_id'] == 0x01:
-        val['action_name'] = 'stroke'
-        (point_count, pos) = read_int(data, pos)
-        points = []
-        point = {}
-        (point['x'], pos) = read_float(data, pos)
-        (point['y'], pos) = read_float(data, pos)
-        (point['p'], pos) = read_float(data, pos)
-        points.append(point)
-
-        x = point['x']
-        y = point['y']
-
-        for i in range(point_count - 1):
-            (tmp, pos) = read_int(data, pos)
-            (byt, pos) = read_byte(data, pos)
-            dx = tmp & 0x3fff
-            if tmp & (1<<14): dx = -dx
-            dy = (tmp >> 15) & 0x3fff
-            if tmp & (1<<29): dy = -dy
-            p = (tmp >> 30) | (byt << 2)
-            x += dx/32.
-            y += dy/32.
-            points.append({'x': x, 'y': y, 'p': p/0x3ff})
-
-        val['points'] = points
-
-    elif val['action_id'] == 0x02:
-        val['action_name'] = 'polyline'
-        (val['points'], pos) = read_polyline(data, pos, 2)
-
-    elif val['action_id'] == 0x03:
-        val['action_name'] = 'polyline'
-        (count, pos) = read_int(data, pos)
-        (val['points'], pos) = read_polyline(data, pos, count)
-
-    elif val['action_id'] == 0x04:
-        val['action_name'] = 'polyline'
-        (count, pos) = read_int(data, pos)
-        (val['points'], pos) = read_polyline(data, pos, count)
-
-    elif val['action_id'] == 0x05:
-        val['action_name'] = 'rect'
-        ([x, y, w, h, angle], pos) = read_float_array(data, pos, 5)
-        val['x'] = x
-        val['y'] = y
-        val['w'] = w
-        val['h'] = h
-        val['angle'] = angle
-
-    elif val['action_id'] == 0x06:
-        val['action_name'] = 'ellipse'
-        ([cx, cy, rx, ry, angle], pos) = read_float_array(data, pos, 5)
-        val['cx'] = cx + rx / 4.0
-        val['cy'] = cy + ry / 4.0
-        val['rx'] = rx / 2.0
-        val['ry'] = ry / 2.0
-        val['angle'] = angle
-
-    elif val['action_id'] == 0x08:
-        val['action_name'] = 'unknown_08'
-        (val['argument'], pos) = read_int(data, pos)
-
-    elif val['action_id'] == 0x33:
-        val['action_name'] = 'pen_matrix'
-        (val['matrix'], pos) = read_float_matrix(data, pos, 4, 4)
-        (val['zoom'], pos) = read_float(data, pos)
-
-    elif val['action_id'] == 0x34:
-        val['action_name'] = 'pen_properties'
-        (val['type'], pos) = read_int(data, pos)
-        (val['noise'], pos) = read_float(data, pos)
-        (val['size'], pos) = read_float(data, pos)
-        (val['size_min'], pos) = read_float(data, pos)
-        (val['opacity'], pos) = read_float(data, pos)
-        (val['opacity_min'], pos) = read_float(data, pos)
-
-    elif val['action_id'] == 0x35:
-        val['action_name'] = 'pen_color'
-        (val['color'], pos) = read_color(data, pos)
-
-    elif val['action_id'] == 0x36:
-        val['action_name'] = 'is_eraser'
-        (is_eraser, pos) = read_int(data, pos)
-        val['is_eraser'] = is_eraser != 0
-
-    elif val['action_id'] == 0x0f:
-        val['action_name'] = 'paste_layer'
-        (val['from_layer'], pos) = read_int(data, pos)
-        (val['rect'], pos) = read_float_array(data, pos, 4)
-        (val['matrix_1'], pos) = read_float_matrix(data, pos, 4, 4)
-        (val['zoom_1'], pos) = read_float(data, pos)
-        (val['matrix_2'], pos) = read_float_matrix(data, pos, 4, 4)
-        (val['zoom_2'], pos) = read_float(data, pos)
-
-    elif val['action_id'] == 0x0d:
-        val['action_name'] = 'layer_matrix'
-        (val['matrix'], pos) = read_float_matrix(data, pos, 4, 4)
-        (val['zoom'], pos) = read_float(data, pos)
-
-    elif val['action_id'] == 0x0e:
-        val['action_name'] = 'cut'
-        (val['rect'], pos) = read_float_array(data, pos, 4)
-
-    elif val['action_id'] == 0x0c:
-        val['action_name'] = 'merge_layer'
-        (val['from_layer'], pos) = read_int(data, pos)
-        (val['opacity_src'], pos) = read_float(data, pos)
-        (val['opactty_dst'], pos) = read_float(data, pos)
-        (val['matrix'], pos) = read_float_matrix(data, pos, 4, 4)
-        (val['zoom'], pos) = read_float(data, pos)
-
-    elif val['action_id'] == 0x07:
-        val['action_name'] = 'draw_image'
-        (val['dst_center'], pos) = read_float_array(data, pos, 2)
-        (val['dst_size'], pos) = read_float_array(data, pos, 2)
-        (val['unknown'], pos) = read_int(data, pos)
-        (val['src_size'], pos) = read_int_array(data, pos, 2)
-        (val['image_id'], pos) = read_int(data, pos)
+STROKE_DELTA_DTYPE = None if np is None else \
+    np.dtype([('bits', '<u4'), ('pressure_high', 'u1')])
 
+def read_stroke_points(data, pos, count):
+    '''
+    Reads the points of a stroke: one absolute point followed by count-1
+    packed deltas. Returns them as flat sequence x, y, p, x, y, p, ...
+    which is a list, or a numpy float64 array for long strokes if numpy
+    is available.
+    '''
+    if np is not None and count >= VECTORIZED_STROKE_MIN_POINTS:
+        return read_stroke_points_vectorized(data, pos, count)
+
+    (coords, pos) = read_float_array(data, pos, 3)
+    (x, y) = (coords[0], coords[1])
+
+    for i in range(count - 1):
+        (tmp, pos) = read_int(data, pos)
+        (byt, pos) = read_byte(data, pos)
+        dx = tmp & 0x3fff
+        if tmp & (1<<14): dx = -dx
+        dy = (tmp >> 15) & 0x3fff
+        if tmp & (1<<29): dy = -dy
+        p = (tmp >> 30) | (byt << 2)
+        x += dx/32.
+        y += dy/32.
+        coords += (x, y, p/0x3ff)
+
+    return (coords, pos)
+
+def read_stroke_points_vectorized(data, pos, count):
+    '''
+    numpy version of read_stroke_points, giving the same values.
+    '''
+    (first, pos) = read_float_array(data, pos, 3)
+    deltas = np.frombuffer(data, dtype=STROKE_DELTA_DTYPE,
+                           count=count-1, offset=pos)
+    bits = deltas['bits']
+    points = np.empty((count, 3))
+    points[0] = first
+    for (column, shift) in ((0, 0), (1, 15)):
+        # negated as integers, so a negative zero is 0.0 like in the loop
+        delta = ((bits >> shift) & 0x3fff).astype(np.int32)
+        np.negative(delta, out=delta, where=(bits & (1 << (shift+14))) != 0)
+        points[1:, column] = delta / 32.
+    points[1:, 2] = ((bits >> 30) | (deltas['pressure_high'].astype(np.uint32) << 2)) / 0x3ff
+    # a running sum starting from the absolute point adds up in the same
+    # order as the plain loop, so the results are identical
+    np.cumsum(points[:, 0], out=points[:, 0])
+    np.cumsum(points[:, 1], out=points[:, 1])
+    return (points.ravel(), pos + 5*(count-1))
+
+def point_dicts(coords):
+    if np is not None and isinstance(coords, np.ndarray):
+        coords = coords.tolist()
+    return [{'x': coords[i], 'y': coords[i+1], 'p': coords[i+2]}
+            for i in range(0, len(coords), 3)]
+
+def store_points(val, coords, points):
+    '''
+    Stores the points of a stroke or polyline in the action val, either
+    as list of dicts, or if points is given, by appending the coordinates
+    to the float array points and recording their position in val.
+    '''
+    if points is None:
+        val['points'] = point_dicts(coords)
+        return
+    val['point_offset'] = len(points) // 3
+    val['point_count'] = len(coords) // 3
+    if np is not None and isinstance(coords, np.ndarray):
+        points.frombytes(coords.astype(np.float32).tobytes())
     else:
+        points.extend(coords)
+
+# Actions are described by ACTION_TYPES, which maps the action id to
+# the action name, a struct for the fixed size part following the layer
+# and action id, and a function that stores the unpacked values in the
+# action dict and returns the position after the action. For variable
+# length actions, that function reads the rest of the action from the
+# data, and a fourth entry gives the size of the rest from the unpacked
+# values.
+
+ACTION_HEADER = struct.Struct('<II')
+
+def fill_stroke(val, v, data, pos, points):
+    (coords, pos) = read_stroke_points(data, pos, v[0])
+    store_points(val, coords, points)
+    return pos
+
+def fill_polyline(val, v, data, pos, points):
+    store_points(val, list(v), points)
+    return pos
+
+def fill_counted_polyline(val, v, data, pos, points):
+    (coords, pos) = read_float_array(data, pos, 3*v[0])
+    store_points(val, coords, points)
+    return pos
+
+def fill_rect(val, v, data, pos, points):
+    (val['x'], val['y'], val['w'], val['h'], val['angle']) = v
+    return pos
+
+def fill_ellipse(val, v, data, pos, points):
+    (cx, cy, rx, ry, angle) = v
+    val['cx'] = cx + rx / 4.0
+    val['cy'] = cy + ry / 4.0
+    val['rx'] = rx / 2.0
+    val['ry'] = ry / 2.0
+    val['angle'] = angle
+    return pos
+
+def fill_unknown_08(val, v, data, pos, points):
+    (val['argument'],) = v
+    return pos
+
+def fill_matrix(val, v, data, pos, points):
+    val['matrix'] = matrix_rows(v[0:16], 4, 4)
+    val['zoom'] = v[16]
+    return pos
+
+def fill_pen_properties(val, v, data, pos, points):
+    (val['type'], val['noise'], val['size'], val['size_min'],
+     val['opacity'], val['opacity_min']) = v
+    return pos
+
+def fill_pen_color(val, v, data, pos, points):
+    val['color'] = v
+    return pos
+
+def fill_is_eraser(val, v, data, pos, points):
+    val['is_eraser'] = v[0] != 0
+    return pos
+
+def fill_paste_layer(val, v, data, pos, points):
+    val['from_layer'] = v[0]
+    val['rect'] = list(v[1:5])
+    val['matrix_1'] = matrix_rows(v[5:21], 4, 4)
+    val['zoom_1'] = v[21]
+    val['matrix_2'] = matrix_rows(v[22:38], 4, 4)
+    val['zoom_2'] = v[38]
+    return pos
+
+def fill_cut(val, v, data, pos, points):
+    val['rect'] = list(v)
+    return pos
+
+def fill_merge_layer(val, v, data, pos, points):
+    (val['from_layer'], val['opacity_src'], val['opactty_dst']) = v[0:3]
+    val['matrix'] = matrix_rows(v[3:19], 4, 4)
+    val['zoom'] = v[19]
+    return pos
+
+def fill_draw_image(val, v, data, pos, points):
+    val['dst_center'] = list(v[0:2])
+    val['dst_size'] = list(v[2:4])
+    val['unknown'] = v[4]
+    val['src_size'] = list(v[5:7])
+    val['image_id'] = v[7]
+    return pos
+
+ACTION_TYPES = {
+    0x01: ('stroke', struct.Struct('<I'), fill_stroke,
+           lambda v: 3*4 + 5*max(v[0] - 1, 0)),
+    0x02: ('polyline', struct.Struct('<6f'), fill_polyline),
+    0x03: ('polyline', struct.Struct('<I'), fill_counted_polyline,
+           lambda v: 3*4*v[0]),
+    0x04: ('polyline', struct.Struct('<I'), fill_counted_polyline,
+           lambda v: 3*4*v[0]),
+    0x05: ('rect', struct.Struct('<5f'), fill_rect),
+    0x06: ('ellipse', struct.Struct('<5f'), fill_ellipse),
+    0x07: ('draw_image', struct.Struct('<4fI2II'), fill_draw_image),
+    0x08: ('unknown_08', struct.Struct('<I'), fill_unknown_08),
+    0x0c: ('merge_layer', struct.Struct('<Iff16ff'), fill_merge_layer),
+    0x0d: ('layer_matrix', struct.Struct('<16ff'), fill_matrix),
+    0x0e: ('cut', struct.Struct('<4f'), fill_cut),
+    0x0f: ('paste_layer', struct.Struct('<I4f16ff16ff'), fill_paste_layer),
+    0x33: ('pen_matrix', struct.Struct('<16ff'), fill_matrix),
+    0x34: ('pen_properties', struct.Struct('<I5f'), fill_pen_properties),
+    0x35: ('pen_color', struct.Struct('<3B'), fill_pen_color),
+    0x36: ('is_eraser', struct.Struct('<I'), fill_is_eraser),
+}
+
+
+def action_size(data, pos):
+    '''
+    Returns the size of the action at pos, or None for unknown actions.
+    Needs the layer and action id and the fixed size part of the action.
+    '''
+    (_, action_id) = ACTION_HEADER.unpack_from(data, pos)
+    action_type = ACTION_TYPES.get(action_id)
+    if action_type is None:
+        return None
+    layout = action_type[1]
+    size = ACTION_HEADER.size + layout.size
+    if len(action_type) > 3:
+        size += action_type[3](layout.unpack_from(data, pos + ACTION_HEADER.size))
+    return size
+
+
+def read_action(data, pos, points=None):
+    start = pos
+    (layer, action_id) = ACTION_HEADER.unpack_from(data, pos)
+    val = {'layer': layer, 'action_id': action_id}
+    pos += ACTION_HEADER.size
+
+    action_type = ACTION_TYPES.get(action_id)
+    if action_type is None:
         import binascii
         print('unknown action: %x' % val['action_id'])
         print(start)
         print(binascii.hexlify(data[start:start+200]))
         die()
 
+    val['action_name'] = action_type[0]
+    layout = action_type[1]
+    values = layout.unpack_from(data, pos)
+    pos = action_type[2](val, values, data, pos + layout.size, points)
     return (val, pos)
 
 
+# actions changing the pen used by later actions
+PEN_STATE_ACTION_IDS = frozenset([0x33, 0x34, 0x35, 0x36])
+
+# header fields in front of and after the pen info
+HEADER_START = struct.Struct('<III3Bf4I')
+HEADER_VIEW = struct.Struct('<If16ff')
+
+
+class PayloadReader():
+    '''
+    Reads records from unpacked data that is available as a sequence
+    of chunks, e.g. from mischief_unpack_stream. The chunks are pulled
+    in as needed and dropped once they have been parsed.
+
+    Records are read with the read_... functions above, after making
+    sure that enough data is available.
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.data = b''
+        self.pos = 0
+
+    def ensure(self, count):
+        '''
+        Makes sure that at least count bytes are available after pos.
+        '''
+        available = len(self.data) - self.pos
+        if available >= count:
+            return
+        # the chunks are joined once, as joining them one by one copies
+        # the data read so far again for every chunk
+        parts = [self.data[self.pos:]] if available else []
+        while available < count:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise Exception('unexpected end of unpacked data')
+            parts.append(chunk)
+            available += len(chunk)
+        self.data = parts[0] if len(parts) == 1 else b''.join(parts)
+        self.pos = 0
+
+    def read(self, size, read_func, *args):
+        self.ensure(size)
+        (val, self.pos) = read_func(self.data, self.pos, *args)
+        return val
+
+    def read_image(self):
+        self.ensure(8)
+        (size, _) = read_int(self.data, self.pos + 4)
+        return self.read(8 + size, read_image)
+
+    def unpack(self, layout):
+        self.ensure(layout.size)
+        val = layout.unpack_from(self.data, self.pos)
+        self.pos += layout.size
+        return val
+
+    def read_action(self, points=None):
+        # enough for the header and the point count, which is all that
+        # action_size reads; the rest of the fixed part is only needed
+        # once the size is known
+        self.ensure(ACTION_HEADER.size + 4)
+        size = action_size(self.data, self.pos)
+        if size is not None:
+            self.ensure(size)
+        return self.read(0, read_action, points)
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class PointList():
+    '''
+    Read-only list of {'x', 'y', 'p'} dicts on top of an (N, 3) float32
+    array of points, for code written against the dict based points.
+    The array itself is available as .array.
+    '''
+    __slots__ = ['array']
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PointList(self.array[index])
+        (x, y, p) = self.array[index].tolist()
+        return {'x': x, 'y': y, 'p': p}
+
+    def __iter__(self):
+        for (x, y, p) in self.array.tolist():
+            yield {'x': x, 'y': y, 'p': p}
+
+    def __repr__(self):
+        return 'PointList(%r)' % (list(self),)
+
+    def __eq__(self, other):
+        if not isinstance(other, PointList):
+            return NotImplemented
+        return np.array_equal(self.array, other.array)
+
+
+def point_array(coords):
+    '''
+    Turns a float array of x, y, p triples into an (N, 3) numpy array.
+    '''
+    return np.frombuffer(coords, dtype=np.float32).reshape(-1, 3)
+
+
+def attach_point_array(action, points):
+    '''
+    Gives an action read with its own points array a PointList over it.
+    '''
+    if 'point_offset' in action:
+        action['points'] = PointList(point_array(points))
+    return action
+
+
+# rdp_mask handles ranges with more points than this with numpy, and
+# shorter ones in a plain loop, which is faster for them than setting up
+# the arrays
+RDP_VECTORIZED_MIN_POINTS = 64
+
+def rdp_mask(xy, tolerance):
+    '''
+    Simplifies a polyline given as (N, 2) array with the Ramer-Douglas-
+    Peucker algorithm: returns a boolean mask of the points to keep, so
+    that no dropped point is further than tolerance from the simplified
+    line. Works through a stack of ranges instead of recursing, with the
+    distances for each long range computed at once.
+    '''
+    count = len(xy)
+    keep = np.zeros(count, dtype=bool)
+    if count == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+    coords = None
+    stack = [(0, count - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        if last - first < 2:
+            continue
+        # distances are to the chord as a segment, not as an infinite line
+        if last - first > RDP_VECTORIZED_MIN_POINTS:
+            start = xy[first]
+            chord = xy[last] - start
+            offsets = xy[first+1:last] - start
+            length2 = chord @ chord
+            if length2 > 0:
+                t = offsets @ chord
+                t /= length2
+                np.clip(t, 0.0, 1.0, out=t)
+                offsets -= t[:, None] * chord
+            distances2 = np.einsum('ij,ij->i', offsets, offsets)
+            index = int(distances2.argmax())
+            (middle, distance2) = (first + 1 + index, distances2[index])
+        else:
+            if coords is None:
+                coords = xy.tolist()
+            (ax, ay) = coords[first]
+            (cx, cy) = coords[last]
+            cx -= ax
+            cy -= ay
+            length2 = cx * cx + cy * cy
+            (middle, distance2) = (first, -1.0)
+            for i in range(first + 1, last):
+                (px, py) = coords[i]
+                px -= ax
+                py -= ay
+                if length2 > 0:
+                    t = (px * cx + py * cy) / length2
+                    t = 0.0 if t < 0.0 else 1.0 if t > 1.0 else t
+                    px -= t * cx
+                    py -= t * cy
+                d2 = px * px + py * py
+                if d2 > distance2:
+                    (middle, distance2) = (i, d2)
+        if distance2 > tolerance2:
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return keep
+
+
+def simplify_points(points, tolerance):
+    '''
+    Simplifies the points of a stroke or polyline with rdp_mask, using
+    their x and y. The kept points retain their pressure. points can be an
+    (N, 3) array, a PointList, or a list of point dicts, and the result is
+    of the same kind.
+    '''
+    if np is None:
+        raise Exception('simplifying points requires numpy')
+    if isinstance(points, PointList):
+        return PointList(points.array[rdp_mask(points.array[:, :2].astype(np.float64), tolerance)])
+    if isinstance(points, np.ndarray):
+        return points[rdp_mask(points[:, :2].astype(np.float64), tolerance)]
+    xy = np.array([(point['x'], point['y']) for point in points], dtype=np.float64).reshape(-1, 2)
+    return [point for (point, keep) in zip(points, rdp_mask(xy, tolerance).tolist()) if keep]
+
+
+def scan_actions(data, pos, count):
+    '''
+    Locates count actions starting at pos, without parsing them.
+    Returns arrays of their offsets, layers and action ids, and the
+    position after the last action.
+    '''
+    offsets = array('Q')
+    layers = array('I')
+    action_ids = array('I')
+    for i in range(count):
+        size = action_size(data, pos)
+        if size is None:
+            # let read_action report it
+            read_action(data, pos)
+        (layer, action_id) = ACTION_HEADER.unpack_from(data, pos)
+        offsets.append(pos)
+        layers.append(layer)
+        action_ids.append(action_id)
+        pos += size
+    return (offsets, layers, action_ids, pos)
+
+
+class LazyActions():
+    '''
+    Read-only list of the actions of an ArtParser created with
+    lazy_actions=True. Actions are parsed from the unpacked data
+    whenever they are accessed, and are not kept.
+    '''
+    def __init__(self, art):
+        self.art = art
+
+    def __len__(self):
+        return len(self.art.action_offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        offset = self.art.action_offsets[index]
+        if not self.art.point_arrays:
+            return read_action(self.art.data, offset)[0]
+        points = array('f')
+        return attach_point_array(read_action(self.art.data, offset, points)[0], points)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def rotated_half_extents(half_w, half_h, angle):
+    '''
+    Returns the half width and height of the bounding box of a rectangle
+    (or with both halves squared, an ellipse) rotated by angle degrees.
+    '''
+    (c, s) = (abs(math.cos(math.radians(angle))), abs(math.sin(math.radians(angle))))
+    return (half_w * c + half_h * s, half_w * s + half_h * c)
+
+
+def action_bbox(action):
+    '''
+    Returns the bounding box (xmin, ymin, xmax, ymax) of what an action
+    draws, in the coordinates of the action (before the layer and pen
+    matrices), or None if it draws nothing. The pen width is not included.
+    Rects and ellipses are placed as strokes2svg draws them.
+    '''
+    name = action['action_name']
+    if 'points' in action:
+        points = action['points']
+        if len(points) == 0:
+            return None
+        if isinstance(points, PointList):
+            (xmin, ymin) = points.array[:, :2].min(axis=0).tolist()
+            (xmax, ymax) = points.array[:, :2].max(axis=0).tolist()
+            return (xmin, ymin, xmax, ymax)
+        xs = [point['x'] for point in points]
+        ys = [point['y'] for point in points]
+        return (min(xs), min(ys), max(xs), max(ys))
+    if name == 'rect':
+        # centered on x, y and rotated around it
+        (hx, hy) = rotated_half_extents(abs(action['w']) / 2.0, abs(action['h']) / 2.0,
+                                        action['angle'])
+        return (action['x'] - hx, action['y'] - hy, action['x'] + hx, action['y'] + hy)
+    if name == 'ellipse':
+        # rotated around cx, cy, with its center moved by -rx/2, -ry/2
+        # in the rotated frame
+        (rx, ry) = (action['rx'], action['ry'])
+        angle = math.radians(action['angle'])
+        (c, s) = (math.cos(angle), math.sin(angle))
+        x = action['cx'] - c * rx / 2.0 + s * ry / 2.0
+        y = action['cy'] - s * rx / 2.0 - c * ry / 2.0
+        hx = math.hypot(rx * c, ry * s)
+        hy = math.hypot(rx * s, ry * c)
+        return (x - hx, y - hy, x + hx, y + hy)
+    if name == 'draw_image':
+        ((x, y), (w, h)) = (action['dst_center'], action['dst_size'])
+        return (x - abs(w) / 2.0, y - abs(h) / 2.0, x + abs(w) / 2.0, y + abs(h) / 2.0)
+    return None
+
+
+def transform_bboxes(bboxes, matrices):
+    '''
+    Transforms an (N, 4) array of boxes by an (N, 4, 4) array of matrices
+    (one per box, applied to row vectors (x, y, 0, 1) like the pen
+    matrices) and returns the boxes around the transformed corners.
+    '''
+    corners = np.stack((bboxes[:, [0, 1]], bboxes[:, [2, 1]],
+                        bboxes[:, [0, 3]], bboxes[:, [2, 3]]), axis=1)
+    # the x, y and w rows and columns of the matrices
+    m = matrices[:, [0, 1, 3]][:, :, [0, 1, 3]]
+    xyw = (corners[:, :, 0, None] * m[:, None, 0] + corners[:, :, 1, None] * m[:, None, 1] +
+           m[:, None, 2])
+    xy = xyw[:, :, :2] / xyw[:, :, 2:]
+    return np.concatenate((xy.min(axis=1), xy.max(axis=1)), axis=1)
+
+
+# number of children of each node of a SpatialIndex
+SPATIAL_NODE_SIZE = 16
+
+class SpatialIndex():
+    '''
+    Packed R-tree over bounding boxes, built with the Sort-Tile-Recursive
+    algorithm and kept in numpy arrays.
+
+    boxes is an (N, 4) array of xmin, ymin, xmax, ymax, and ids gives the
+    value query returns for each of them. If layers gives the layer of
+    each box, queries can be limited to some layers. levels[0] holds the
+    boxes in packed order, and the box of node j of levels[k+1] covers
+    nodes j*SPATIAL_NODE_SIZE up to (j+1)*SPATIAL_NODE_SIZE of levels[k].
+    '''
+    def __init__(self, boxes, ids, layers=None):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        order = self.str_order(boxes)
+        self.ids = np.asarray(ids)[order]
+        self.layers = None if layers is None else np.asarray(layers)[order]
+        self.levels = [boxes[order]]
+        while len(self.levels[-1]) > 1:
+            below = self.levels[-1]
+            starts = np.arange(0, len(below), SPATIAL_NODE_SIZE)
+            self.levels.append(np.column_stack((
+                np.minimum.reduceat(below[:, 0], starts),
+                np.minimum.reduceat(below[:, 1], starts),
+                np.maximum.reduceat(below[:, 2], starts),
+                np.maximum.reduceat(below[:, 3], starts))))
+
+    @staticmethod
+    def str_order(boxes):
+        # sorts by center x into vertical slices of about sqrt(N/B) nodes
+        # each, and by center y within the slices
+        count = len(boxes)
+        nodes = -(-count // SPATIAL_NODE_SIZE)
+        slice_size = SPATIAL_NODE_SIZE * max(int(math.ceil(math.sqrt(nodes))), 1)
+        center_x = boxes[:, 0] + boxes[:, 2]
+        center_y = boxes[:, 1] + boxes[:, 3]
+        order = np.argsort(center_x, kind='stable')
+        slices = np.arange(count) // slice_size
+        return order[np.lexsort((center_y[order], slices))]
+
+    def query(self, rect, layers=None):
+        '''
+        Returns the ids of the boxes intersecting rect (xmin, ymin, xmax,
+        ymax), touching edges included, in packed order. With layers, only
+        boxes on those layers are returned.
+        '''
+        (xmin, ymin, xmax, ymax) = rect
+        if len(self.ids) == 0:
+            return self.ids[:0]
+        candidates = np.arange(len(self.levels[-1]))
+        for depth in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[depth][candidates]
+            candidates = candidates[(boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) &
+                                    (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)]
+            if depth > 0:
+                children = (candidates[:, None] * SPATIAL_NODE_SIZE +
+                            np.arange(SPATIAL_NODE_SIZE)).ravel()
+                candidates = children[children < len(self.levels[depth - 1])]
+        if layers is not None:
+            candidates = candidates[np.isin(self.layers[candidates], list(layers))]
+        return self.ids[candidates]
+
+
+# decompression chunk size for ArtParser.probe; the metadata it reads
+# is usually only a few kilobytes
+PROBE_CHUNK_SIZE = 0x1000
+
+# ArtParser.load_async decompresses this much output per executor job,
+# and lets other loads have their turn in between
+ASYNC_CHUNK_SIZE = 1 << 20
+
+# how many files ArtParser.load_async decompresses at the same time by default
+DEFAULT_ASYNC_DECODES = 2
+
+# default semaphores of load_async, one per event loop
+_decode_semaphores = weakref.WeakKeyDictionary()
+
+def decode_semaphore(loop):
+    semaphore = _decode_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _decode_semaphores[loop] = asyncio.Semaphore(DEFAULT_ASYNC_DECODES)
+    return semaphore
+
+
+def map_file(fname):
+    '''
+    Maps an .art file into memory. The mmap is read like a file for the
+    header, while the compressed payload is decoded from it in place.
+    '''
+    with open(fname, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < 0x08:
+            raise Exception('file is too small to be an .art file')
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 class ArtParser(object):
     '''
     Class for parsing an .art file.
     Usage: parsed = ArtParser(filename)
+
+    To go over the actions in a single pass without keeping all of them
+    in memory, use ArtParser(filename, stream_actions=True) and iterate
+    over parsed.iter_actions().
+
+    With point_arrays=True (requires numpy), the points of all strokes and
+    polylines are stored in one (N, 3) float32 array parsed.points, with
+    columns x, y and p. Those actions get 'point_offset' and 'point_count'
+    entries giving their slice of parsed.points, and their 'points' entry
+    is a PointList view of it. With stream_actions or lazy_actions, every
+    action gets its own array instead.
+
+    With lazy_actions=True, the actions are only located by a quick scan,
+    which fills the arrays parsed.action_offsets, parsed.action_layers and
+    parsed.action_ids. parsed.actions is then a LazyActions list that
+    parses an action every time it is accessed.
+
+    Unless the actions are streamed, parsed.layer_index maps each layer
+    number to an array of the indices of the actions on that layer, and
+    parsed.pen_state_index lists the actions that change the pen state.
+    actions_for_layer and actions_for_layers use them to visit the actions
+    of some layers only.
+    parsed.query(rect) finds the actions drawing within a rectangle through
+    a spatial index over their bounding boxes (requires numpy).
+
+    With a cache (see artcache.PayloadCache), the decompressed payload is
+    taken from the cache when possible, and added to it otherwise. The
+    cache is not used when streaming the actions.
+
+    progress is called with the number of bytes decompressed so far and
+    the total, see MischiefUnpacker. With stream_actions, it is called as
+    the actions are iterated over, and when the payload comes from the
+    cache, it is called once with the full length.
     '''
     data = None
     raw_size = 0
@@ -627,40 +1705,187 @@ class ArtParser(object):
     layer_order = None
     layers = None
     images = None
+    action_count = None
     actions = None
     unknown_eof = None
     pins = None
-
-    def __init__(self, fname):
-        with open(fname, 'rb') as fd:
-            magic = fd.read(0x08)
-            if len(magic) < 0x08:
-                raise Exception('file is too small to be an .art file')
-            if magic[0:4] not in ART_MAGICS:
-                raise Exception('bad file magic')
-            (ver,) = struct.unpack('I', magic[4:8])
-
-            if ver & 0xFF == 00:
-              header = fd.read(0x08)
-              if len(header) < 0x08:
-                raise Exception('file is too small to be an .art file')
-            elif ver == 0x81:
-              header = fd.read(0x1C)
-              if len(header) < 0x1C:
-                raise Exception('file is too small to be an .art file')
-            elif ver == 0x82:
-              header = fd.read(0x21)
-              if len(header) < 0x21:
-                raise Exception('file is too small to be an .art file')
-              self.read_pins(fd)
+    action_offsets = None
+    action_layers = None
+    action_ids = None
+    layer_index = None
+    pen_state_index = None
+    action_bboxes = None
+    spatial_index = None
+    points = None
+    point_arrays = False
+    lazy_actions = False
+    fname = None
+    cache = None
+    progress = None
+    mapped_file = None
+    payload = None
+    reader = None
+    probed = False
+
+    def __init__(self, fname, stream_actions=False, point_arrays=False,
+                 lazy_actions=False, cache=None, progress=None):
+        if point_arrays and np is None:
+            raise Exception('point_arrays requires numpy')
+        if stream_actions and lazy_actions:
+            raise Exception('lazy_actions needs the whole payload, it cannot be streamed')
+        self.point_arrays = point_arrays
+        self.lazy_actions = lazy_actions
+        self.fname = fname
+        self.cache = cache
+        self.progress = progress
+        self.mapped_file = map_file(fname)
+        try:
+            self.read_file(self.mapped_file, stream_actions)
+        finally:
+            if self.reader is None:
+                self.close()
+
+    @classmethod
+    async def load_async(cls, fname, executor=None, point_arrays=False,
+                         lazy_actions=False, semaphore=None,
+                         chunk_size=ASYNC_CHUNK_SIZE):
+        '''
+        Parses a file like ArtParser(fname) without blocking the event loop.
+        Usage: parsed = await ArtParser.load_async(filename)
+
+        The file is read, decompressed and parsed in executor, which has to
+        be a thread pool (the default executor of the loop if None). The
+        payload is decompressed in jobs of chunk_size bytes of output, each
+        holding semaphore, so at most that many files are decompressed at
+        the same time, and a large file lets waiting ones go in between its
+        chunks. The default semaphore allows DEFAULT_ASYNC_DECODES.
+
+        Cancelling the load stops it after the chunk that is running.
+        '''
+        if point_arrays and np is None:
+            raise Exception('point_arrays requires numpy')
+        loop = asyncio.get_running_loop()
+        if semaphore is None:
+            semaphore = decode_semaphore(loop)
+        art = cls.__new__(cls)
+        art.point_arrays = point_arrays
+        art.lazy_actions = lazy_actions
+        art.fname = fname
+
+        def open_payload():
+            art.mapped_file = map_file(fname)
+            art.payload = art.read_file_header(art.mapped_file)
+            return MischiefUnpacker(art.payload)
+
+        job = None
+        def run(func, *args):
+            # the job is shielded, so cancelling the load does not mark it
+            # as done while the worker thread is still running it
+            nonlocal job
+            job = loop.run_in_executor(executor, func, *args)
+            return asyncio.shield(job)
+
+        def close_when_done(job):
+            if not job.cancelled():
+                # nobody is waiting for the result any more; this keeps an
+                # error from being reported as never retrieved
+                job.exception()
+            art.close()
+
+        try:
+            unpacker = await run(open_payload)
+            while not unpacker.is_finished():
+                await semaphore.acquire()
+                try:
+                    step = run(unpacker.step, chunk_size)
+                except BaseException:
+                    semaphore.release()
+                    raise
+                # the slot is given back when the job is done, not when a
+                # cancelled load stops waiting for it
+                job.add_done_callback(lambda job: semaphore.release())
+                await step
+            art.data = unpacker.output.get_data()
+            await run(art.parse_unpacked)
+        finally:
+            # the file stays open until a job that is still using it is done
+            if job is not None and not job.done():
+                job.add_done_callback(close_when_done)
             else:
-              raise Exception('unknown art file version: %d' % ver)
-
-            (self.raw_size,) = struct.unpack('I', fd.read(4))
-            self.data = fd.read(self.raw_size)
-            self.data = mischief_unpack(self.data)
+                art.close()
+        return art
+
+    @classmethod
+    def probe(cls, fname, images=False):
+        '''
+        Reads only the metadata in front of the actions: the header, pen
+        info, view matrix, layer order, pins and layers, and if images is
+        set, the images and the action count. Decompression stops as soon
+        as these have been parsed. The actions are left at None, and
+        iter_actions raises an error.
+        '''
+        art = cls.__new__(cls)
+        art.probed = True
+        with map_file(fname) as fd:
+            with art.read_file_header(fd) as payload:
+                reader = PayloadReader(mischief_unpack_stream(payload, PROBE_CHUNK_SIZE))
+                try:
+                    art.parse_header(reader, images)
+                finally:
+                    reader.close()
+        return art
+
+    def read_file(self, fd, stream_actions=False):
+        '''
+        Reads the file header and the compressed payload from fd, which
+        has to be a mapped file (or another buffer with a file interface).
+
+        With stream_actions, only the data in front of the actions is
+        parsed; the actions are decompressed and parsed by iter_actions.
+        '''
+        self.payload = self.read_file_header(fd)
+        if stream_actions:
+            reader = PayloadReader(mischief_unpack_stream(self.payload, progress=self.progress))
+            self.parse_header(reader)
+            self.reader = reader
+        elif self.cache is not None:
+            self.data = self.cache.unpack(self.fname, self.payload, self.progress)
             self.parse_unpacked()
+        else:
+            self.data = mischief_unpack(self.payload, self.progress)
+            self.parse_unpacked()
+
+    def read_file_header(self, fd):
+        '''
+        Reads the header of the file up to the compressed payload, and
+        returns a memoryview of the payload.
+        '''
+        magic = fd.read(0x08)
+        if len(magic) < 0x08:
+            raise Exception('file is too small to be an .art file')
+        if magic[0:4] not in ART_MAGICS:
+            raise Exception('bad file magic')
+        (ver,) = struct.unpack('I', magic[4:8])
+
+        if ver & 0xFF == 00:
+          header = fd.read(0x08)
+          if len(header) < 0x08:
+            raise Exception('file is too small to be an .art file')
+        elif ver == 0x81:
+          header = fd.read(0x1C)
+          if len(header) < 0x1C:
+            raise Exception('file is too small to be an .art file')
+        elif ver == 0x82:
+          header = fd.read(0x21)
+          if len(header) < 0x21:
+            raise Exception('file is too small to be an .art file')
+          self.read_pins(fd)
+        else:
+          raise Exception('unknown art file version: %d' % ver)
 
+        (self.raw_size,) = struct.unpack('I', fd.read(4))
+        start = fd.tell()
+        return memoryview(fd)[start:start+self.raw_size]
 
     def read_pins(self, fd):
       self.pins = []
@@ -674,71 +1899,263 @@ class ArtParser(object):
         self.pins.append(pin)
 
     def parse_unpacked(self):
-        pos = 0
-        data = self.data
-        (self.version, pos) = read_int(data, pos)
-        (self.active_layer_num, pos) = read_int(data, pos)
-        (self.unknonw_08, pos) = read_int(data, pos)
-        (self.background_color, pos) = read_color(data, pos)
-        (self.background_alpha, pos) = read_float(data, pos)
-        (self.unknown_13, pos) = read_int(data, pos)
-        (self.unknown_17, pos) = read_int(data, pos)
-        (self.unknown_1b, pos) = read_int(data, pos)
-        (self.unknown_1f, pos) = read_int(data, pos)
-        (self.pen_info, pos) = read_pen_info(data, pos)
-        (self.unknown_42, pos) = read_int(data, pos)
-        (self.unknown_46, pos) = read_float(data, pos)
-        (self.view_matrix, pos) = read_float_matrix(data, pos, 4, 4)
-        (self.view_zoom, pos) = read_float(data, pos)
-        (order_count, pos) = read_int(data, pos)
-        (self.layer_order, pos) = read_int_array(data, pos, order_count)
-
-        (layer_count, pos) = read_int(data, pos)
+        reader = PayloadReader([self.data])
+        self.parse_header(reader)
+        self.layer_index = {}
+        self.pen_state_index = array('I')
+        if self.lazy_actions:
+            (self.action_offsets, self.action_layers, self.action_ids, pos) = \
+                scan_actions(self.data, reader.pos, self.action_count)
+            self.actions = LazyActions(self)
+            (self.unknown_eof, pos) = read_int(self.data, pos)
+            for i in range(self.action_count):
+                self.index_action(i, self.action_layers[i], self.action_ids[i])
+            return
+
+        self.actions = []
+        points = array('f') if self.point_arrays else None
+
+        for i in range(self.action_count):
+            action = reader.read_action(points)
+            self.actions.append(action)
+            self.index_action(i, action['layer'], action['action_id'])
+
+        self.unknown_eof = reader.read(4, read_int)
+
+        if points is not None:
+            self.points = point_array(points)
+            for action in self.actions:
+                if 'point_offset' in action:
+                    start = action['point_offset']
+                    end = start + action['point_count']
+                    action['points'] = PointList(self.points[start:end])
+
+    def index_action(self, index, layer, action_id):
+        if layer not in self.layer_index:
+            self.layer_index[layer] = array('I')
+        self.layer_index[layer].append(index)
+        if action_id in PEN_STATE_ACTION_IDS:
+            self.pen_state_index.append(index)
+
+    def actions_for_layer(self, layer, pen_state=False):
+        '''
+        Yields the actions on the given layer, see actions_for_layers.
+        '''
+        return self.actions_for_layers([layer], pen_state)
+
+    def actions_for_layers(self, layers, pen_state=False):
+        '''
+        Yields the actions on the given layers in file order, without
+        visiting the actions on other layers.
+
+        The pen state set by an action applies to the following actions
+        on all layers. With pen_state=True, the actions changing it are
+        included regardless of their layer, so that the pen state can be
+        tracked as when going through all actions.
+        '''
+        if self.layer_index is None:
+            raise Exception('no layer index, the actions were not parsed')
+        positions = [self.layer_index.get(layer, ()) for layer in set(layers)]
+        if pen_state:
+            positions.append(self.pen_state_index)
+        last = -1
+        for index in heapq.merge(*positions):
+            if index != last:
+                yield self.actions[index]
+            last = index
+
+    def compute_bboxes(self):
+        '''
+        Fills parsed.action_bboxes, an (N, 4) array with the bounding box
+        of each action, and NaN for actions that don't draw anything. The
+        boxes are in document coordinates: the box of each action (see
+        action_bbox) is grown by half the pen width if it is drawn with
+        the pen, transformed by the layer and pen matrix in effect for
+        it, the way the exporters draw it, and the box around its
+        transformed corners is taken. With a document-wide points array,
+        the boxes of the strokes and polylines are taken from it all at
+        once.
+        '''
+        if np is None:
+            raise Exception('bounding boxes require numpy')
+        if self.layer_index is None:
+            raise Exception('no bounding boxes, the actions were not parsed')
+        bboxes = np.full((len(self.actions), 4), np.nan)
+        with_points = []
+        # the matrices set by the pen matrix actions, and which one each
+        # action is drawn with
+        matrices = [np.eye(4)]
+        matrix_of = np.zeros(len(self.actions), dtype=np.int64)
+        # half the pen width each action is drawn with
+        padding = np.zeros(len(self.actions))
+        pen_size = 1.0
+        for (i, action) in enumerate(self.actions):
+            if action['action_id'] == 51:
+                matrices.append(np.asarray(self.layers[action['layer']]['matrix'], dtype=np.float64)
+                                @ np.asarray(action['matrix'], dtype=np.float64))
+                continue
+            if action['action_id'] == 0x34:
+                pen_size = action['size']
+                continue
+            matrix_of[i] = len(matrices) - 1
+            if action['action_name'] != 'draw_image':
+                padding[i] = abs(pen_size) / 2.0
+            if self.points is not None and 'point_offset' in action:
+                if action['point_count']:
+                    with_points.append((i, action['point_offset']))
+                continue
+            bbox = action_bbox(action)
+            if bbox is not None:
+                bboxes[i] = bbox
+        if with_points:
+            (indices, offsets) = (np.array(column) for column in zip(*with_points))
+            # the point ranges of the actions follow each other without gaps
+            xy = self.points[:, :2]
+            bboxes[indices, :2] = np.minimum.reduceat(xy, offsets)
+            bboxes[indices, 2:] = np.maximum.reduceat(xy, offsets)
+        bboxes[:, :2] -= padding[:, None]
+        bboxes[:, 2:] += padding[:, None]
+        self.action_bboxes = transform_bboxes(bboxes, np.array(matrices)[matrix_of])
+
+    def query(self, rect, layers=None):
+        '''
+        Returns a sorted array of the indices of the actions whose bounding
+        box (see compute_bboxes) intersects rect, given as (xmin, ymin,
+        xmax, ymax) in document coordinates. With layers, only actions on
+        those layers are returned.
+
+        The bounding boxes and a SpatialIndex over them are built on the
+        first query, and kept in parsed.action_bboxes and
+        parsed.spatial_index.
+        '''
+        if self.spatial_index is None:
+            if self.action_bboxes is None:
+                self.compute_bboxes()
+            layer_of = np.zeros(len(self.actions), dtype=np.int64)
+            for (layer, indices) in self.layer_index.items():
+                layer_of[np.frombuffer(indices, dtype=np.uint32)] = layer
+            present = np.flatnonzero(~np.isnan(self.action_bboxes[:, 0]))
+            self.spatial_index = SpatialIndex(self.action_bboxes[present], present,
+                                              layer_of[present])
+        return np.sort(self.spatial_index.query(rect, layers))
+
+    def parse_header(self, reader, images=True):
+        '''
+        Parses everything in front of the actions, up to and including
+        the action count. Without images, stops after the layers.
+        '''
+        (self.version, self.active_layer_num, self.unknonw_08,
+         bg_red, bg_green, bg_blue, self.background_alpha,
+         self.unknown_13, self.unknown_17, self.unknown_1b,
+         self.unknown_1f) = reader.unpack(HEADER_START)
+        self.background_color = (bg_red, bg_green, bg_blue)
+        self.pen_info = reader.read(PEN_INFO.size, read_pen_info)
+        view = reader.unpack(HEADER_VIEW)
+        (self.unknown_42, self.unknown_46) = view[0:2]
+        self.view_matrix = matrix_rows(view[2:18], 4, 4)
+        self.view_zoom = view[18]
+        order_count = reader.read(4, read_int)
+        self.layer_order = reader.read(4*order_count, read_int_array, order_count)
+
+        layer_count = reader.read(4, read_int)
         self.layers = []
 
         for i in range(layer_count):
-            (layer_info, pos) = read_layer_info(data, pos)
-            self.layers.append(layer_info)
+            self.layers.append(reader.read(LAYER_INFO.size, read_layer_info))
 
-        (images_count, pos) = read_int(data, pos)
+        if not images:
+            return
+
+        images_count = reader.read(4, read_int)
         self.images = []
 
         for i in range(images_count):
-            (image, pos) = read_image(data,pos)
-            self.images.append(image)
-
-        (action_count, pos) = read_int(data, pos)
-        self.actions = []
-
-        for i in range(action_count):
-            (action, pos) = read_action(data, pos)
-            self.actions.append(action)
-
-        (self.unknown_eof, pos) = read_int(data, pos)
+            self.images.append(reader.read_image())
+
+        self.action_count = reader.read(4, read_int)
+
+    def iter_actions(self):
+        '''
+        Yields the actions one at a time.
+
+        For a parser created with stream_actions=True, the actions are
+        parsed while the payload is being decompressed and are not kept,
+        so they can only be iterated over once. Otherwise this iterates
+        over self.actions.
+        '''
+        if self.actions is not None:
+            for action in self.actions:
+                yield action
+            return
+        if self.probed:
+            raise Exception('the parser was created by probe, it has no actions')
+        if self.reader is None:
+            raise Exception('the actions have already been iterated over')
+        (reader, self.reader) = (self.reader, None)
+        try:
+            for i in range(self.action_count):
+                if not self.point_arrays:
+                    yield reader.read_action()
+                    continue
+                points = array('f')
+                yield attach_point_array(reader.read_action(points), points)
+            self.unknown_eof = reader.read(4, read_int)
+        finally:
+            reader.close()
+            self.close()
+
+    def close(self):
+        '''
+        Releases the input file of a parser created with stream_actions=True
+        before all of its actions have been iterated over.
+        '''
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.payload is not None:
+            self.payload.release()
+            self.payload = None
+        if self.mapped_file is not None:
+            self.mapped_file.close()
+            self.mapped_file = None
+
+
+def print_art(art, file=None):
+    '''
+    Prints the parsed contents of an .art file in a readable form to file
+    (stdout by default). The actions are left out if they were not parsed.
+    '''
+    from pprint import pprint
+    print('pen info:', file=file)
+    pprint(art.pen_info, file)
+    print('view matrix:', file=file)
+    pprint(art.view_matrix, file)
+    print('layer order:', file=file)
+    pprint(art.layer_order, file)
+    print('pins:', file=file)
+    pprint(art.pins, file)
+    print('layer info:', file=file)
+    pprint(art.layers, file)
+    #print('images:', file=file)
+    #pprint(art.images, file)
+    if art.actions is not None:
+        print('actions:', file=file)
+        pprint(art.actions, file)
 
 
 # simple wrapper for calling this file from command line
 def main(argv):
-    from pprint import pprint
-    if len(argv) < 2:
-        print('usage: artparser.py <input file>')
+    probe = '--probe' in argv[1:]
+    args = [arg for arg in argv[1:] if arg != '--probe']
+    if len(args) < 1:
+        print('usage: artparser.py [--probe] <input file>')
         return 1
 
-    art = ArtParser(argv[1])
-    print('pen info:')
-    pprint(art.pen_info)
-    print('view matrix:')
-    pprint(art.view_matrix)
-    print('layer order:')
-    pprint(art.layer_order)
-    print('pins:')
-    pprint(art.pins)
-    print('layer info:')
-    pprint(art.layers)
-    #print('images:')
-    #pprint(art.images)
-    print('actions:')
-    pprint(art.actions)
+    if probe:
+        art = ArtParser.probe(args[0])
+    else:
+        art = ArtParser(args[0])
+    print_art(art)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,439 @@
+import argparse
+import math
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import artparser
+from strokes2svg import pointsXY
+
+# Width of the image in pixels if no other is given
+DEFAULT_WIDTH = 1024
+
+# Size of the square tiles the image is rendered in, in pixels
+DEFAULT_TILE_SIZE = 256
+
+# Strokes are simplified to this distance in pixels before they are drawn,
+# which takes out most of the points of strokes that get small in the image
+RASTER_SIMPLIFY = 0.25
+
+# Number of segments the outline of an ellipse is drawn with
+ELLIPSE_SEGMENTS = 64
+
+# Returns the x, y and pressure of a list of points as (N, 3) array.
+def pointsXYP( points ):
+    if isinstance( points, artparser.PointList ):
+        return points.array.astype( np.float64 )
+    return np.array( [ ( point['x'], point['y'], point['p'] ) for point in points ],
+                     dtype = np.float64 ).reshape( -1, 3 )
+
+# Applies a 4x4 matrix in the row vector convention of the pen matrices
+# (see strokes2svg.affine2d) to an (N, 2) array of points, including the
+# perspective division.
+def transformXY( xy, matrix ):
+    m = np.asarray( matrix, dtype = np.float64 )
+    xyw = np.column_stack( ( xy, np.ones( len( xy ) ) ) ) @ m[ [ 0, 1, 3 ] ][ :, [ 0, 1, 3 ] ]
+    return xyw[ :, :2 ] / xyw[ :, 2: ]
+
+# Returns the closed outline of a rect or ellipse action as (N, 2) array,
+# placed the way strokes2svg draws them.
+def shapeOutline( action ):
+    angle = math.radians( action[ 'angle' ] )
+    ( c, s ) = ( math.cos( angle ), math.sin( angle ) )
+    if action[ 'action_name' ] == 'rect':
+        ( hw, hh ) = ( action[ 'w' ] / 2.0, action[ 'h' ] / 2.0 )
+        local = np.array( [ ( -hw, -hh ), ( hw, -hh ), ( hw, hh ), ( -hw, hh ), ( -hw, -hh ) ] )
+        center = ( action[ 'x' ], action[ 'y' ] )
+    else:
+        ( rx, ry ) = ( action[ 'rx' ], action[ 'ry' ] )
+        t = np.linspace( 0.0, 2.0 * math.pi, ELLIPSE_SEGMENTS + 1 )
+        local = np.column_stack( ( rx * np.cos( t ) - rx / 2.0, ry * np.sin( t ) - ry / 2.0 ) )
+        center = ( action[ 'cx' ], action[ 'cy' ] )
+    return local @ np.array( [ [ c, s ], [ -s, c ] ] ) + center
+
+# What the tile renderers draw: the strokes of an art file in pixel
+# coordinates, with their pen state, and how to combine the layers.
+# The points of all strokes are kept in a few flat arrays, so the scene
+# is quick to send to the worker processes.
+# xy and radius hold the points and the pen radius at each of them, and
+# the points of stroke i run from starts[ i ] to starts[ i + 1 ]. The
+# other per-stroke arrays give its layer, color (0 to 1), opacity,
+# whether it is an eraser and its bounding box in pixels, including the
+# pen width. layerOrder lists ( layer number, opacity ) bottom to top,
+# and background is the premultiplied RGBA of the background.
+class RasterScene:
+    def __init__( self, width, height, background, layerOrder ):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.layerOrder = layerOrder
+        self.xy = np.zeros( ( 0, 2 ), dtype = np.float32 )
+        self.radius = np.zeros( 0, dtype = np.float32 )
+        self.starts = np.zeros( 1, dtype = np.int64 )
+        self.layer = np.zeros( 0, dtype = np.int32 )
+        self.color = np.zeros( ( 0, 3 ), dtype = np.float32 )
+        self.opacity = np.zeros( 0, dtype = np.float32 )
+        self.eraser = np.zeros( 0, dtype = bool )
+        self.boxes = np.zeros( ( 0, 4 ), dtype = np.float64 )
+        self.index = None
+
+    # The spatial index isn't sent along to the workers, they build their
+    # own (see buildIndex)
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        state[ 'index' ] = None
+        return state
+
+    def buildIndex( self ):
+        self.index = artparser.SpatialIndex( self.boxes, np.arange( len( self.boxes ) ) )
+
+# Collects what the actions of an art file draw, as they are fed to it
+# one by one, tracking the pen state the same way as SvgExporter.
+# Strokes are drawn with their width scaled by the pressure of each
+# point, between the size_min fraction of the pen size at no pressure
+# and the full size. Polylines and the outlines of rects and ellipses
+# are drawn with the full pen size.
+# If layers is given, only those layers (a list of layer numbers) are
+# drawn, even if they are hidden; otherwise all visible layers are.
+class SceneBuilder:
+    def __init__( self, artFile, layers = None ):
+        self.artFile = artFile
+        if layers is None:
+            layers = [ layerIdx for ( layerIdx, layer ) in enumerate( artFile.layers )
+                       if layer[ 'visible' ] ]
+        self.layers = set( layers )
+
+        # The strokes in document coordinates: ( layer, xy, radius, color,
+        # opacity, eraser )
+        self.strokes = []
+
+        self.matrix = np.eye( 4 )
+        self.setScale()
+
+        # Pen state
+        self.penColor = ( 0, 0, 0 )
+        self.penAlpha = 1.0
+        self.penSize  = 1.0
+        self.penSizeMin = 1.0
+        self.isEraser = False
+
+    def feed( self, action ):
+        if action[ 'action_id' ] == 51:
+            layer_matrix = np.asarray( self.artFile.layers[ action[ 'layer' ] ][ 'matrix' ] )
+            self.matrix = layer_matrix @ np.asarray( action[ 'matrix' ] )
+            self.setScale()
+
+        elif action[ 'action_id' ] == 0x35:
+            self.penColor = action[ 'color' ]
+
+        elif action[ 'action_id' ] == 0x34:
+            self.penSize  = action[ 'size'    ]
+            self.penSizeMin = action[ 'size_min' ]
+            self.penAlpha = action[ 'opacity' ]
+
+        elif action[ 'action_name' ] == 'is_eraser':
+            self.isEraser = action[ 'is_eraser' ]
+
+        elif action[ 'layer' ] not in self.layers:
+            pass
+
+        elif action[ 'action_id' ] == 1:
+            xyp = pointsXYP( action[ 'points' ] )
+            pressure = np.clip( xyp[ :, 2 ], 0.0, 1.0 )
+            scale = self.penSizeMin + ( 1.0 - self.penSizeMin ) * pressure
+            self.add( action, xyp[ :, :2 ], scale )
+
+        elif action[ 'action_name' ] == 'polyline':
+            xy = pointsXY( action[ 'points' ] )
+            self.add( action, xy, np.ones( len( xy ) ) )
+
+        elif action[ 'action_name' ] in ( 'rect', 'ellipse' ):
+            xy = shapeOutline( action )
+            self.add( action, xy, np.ones( len( xy ) ) )
+
+    # Adds a stroke through the points xy (before the pen matrix), with the
+    # pen size multiplied by sizeScale at each point
+    def add( self, action, xy, sizeScale ):
+        if len( xy ) == 0:
+            return
+        radius = sizeScale * ( self.penSize * self.outputScale / 2.0 )
+        self.strokes.append( ( action[ 'layer' ], transformXY( xy, self.matrix ), radius,
+                               self.penColor, self.penAlpha, bool( self.isEraser ) ) )
+
+    # outputScale is the square root of the area scale of the pen matrix,
+    # which the pen width is scaled by
+    def setScale( self ):
+        self.outputScale = abs( np.linalg.det( self.matrix[ :2, :2 ] ) ) ** 0.5
+
+    # Returns the document bounding box of all strokes including the pen
+    # width as ( xmin, ymin, xmax, ymax ), or None if there are none.
+    def bounds( self ):
+        if not self.strokes:
+            return None
+        lows = np.array( [ ( xy - radius[ :, None ] ).min( axis = 0 )
+                           for ( _, xy, radius, _, _, _ ) in self.strokes ] )
+        highs = np.array( [ ( xy + radius[ :, None ] ).max( axis = 0 )
+                            for ( _, xy, radius, _, _, _ ) in self.strokes ] )
+        return tuple( lows.min( axis = 0 ).tolist() + highs.max( axis = 0 ).tolist() )
+
+    # Builds the RasterScene for an image width pixels wide showing the
+    # document rectangle bounds (by default, everything that is drawn).
+    # The y axis points up in the document, as in the SVG.
+    def scene( self, width = DEFAULT_WIDTH, bounds = None ):
+        if bounds is None:
+            bounds = self.bounds() or ( 0.0, 0.0, 1.0, 1.0 )
+        ( xmin, ymin, xmax, ymax ) = bounds
+        scale = width / ( xmax - xmin ) if xmax > xmin else 1.0
+        height = max( int( math.ceil( ( ymax - ymin ) * scale ) ), 1 )
+
+        layerOrder = [ layerIdx for layerIdx in self.artFile.layer_order
+                       if 0 <= layerIdx < len( self.artFile.layers ) ]
+        layerOrder += sorted( set( range( len( self.artFile.layers ) ) ) - set( layerOrder ) )
+        # layer_order is the order strokes2svg writes the layers in, so the
+        # last one is on top
+        layerOrder = [ ( layerIdx, self.artFile.layers[ layerIdx ][ 'opacity' ] )
+                       for layerIdx in layerOrder if layerIdx in self.layers ]
+
+        alpha = self.artFile.background_alpha
+        background = np.array( [ c / 255.0 * alpha for c in self.artFile.background_color ] + [ alpha ],
+                               dtype = np.float32 )
+        scene = RasterScene( width, height, background, layerOrder )
+
+        xys = []
+        radii = []
+        for ( layerIdx, xy, radius, color, opacity, eraser ) in self.strokes:
+            pixels = np.column_stack( ( ( xy[ :, 0 ] - xmin ) * scale, ( ymax - xy[ :, 1 ] ) * scale ) )
+            if len( pixels ) > 2:
+                keep = artparser.rdp_mask( pixels, RASTER_SIMPLIFY )
+                ( pixels, radius ) = ( pixels[ keep ], radius[ keep ] )
+            xys.append( pixels )
+            radii.append( radius * scale )
+        if self.strokes:
+            scene.xy = np.concatenate( xys ).astype( np.float32 )
+            scene.radius = np.concatenate( radii ).astype( np.float32 )
+            scene.starts = np.concatenate( ( [ 0 ], np.cumsum( [ len( xy ) for xy in xys ] ) ) )
+            scene.layer = np.array( [ stroke[ 0 ] for stroke in self.strokes ], dtype = np.int32 )
+            scene.color = np.array( [ stroke[ 3 ] for stroke in self.strokes ], dtype = np.float32 ) / 255.0
+            scene.opacity = np.array( [ stroke[ 4 ] for stroke in self.strokes ], dtype = np.float32 )
+            scene.eraser = np.array( [ stroke[ 5 ] for stroke in self.strokes ], dtype = bool )
+            # one pixel more on each side for the antialiasing
+            margins = np.array( [ r.max() + 1.0 for r in radii ] )[ :, None ]
+            scene.boxes = np.column_stack( (
+                np.array( [ xy.min( axis = 0 ) for xy in xys ] ) - margins,
+                np.array( [ xy.max( axis = 0 ) for xy in xys ] ) + margins ) )
+        return scene
+
+# Returns the RasterScene for the given art file. If layers is given, only
+# those layers (a list of layer numbers) are drawn, and only their actions
+# (plus the ones setting the pen state) are visited.
+def buildScene( artFile, width = DEFAULT_WIDTH, layers = None ):
+    if layers is None:
+        actions = artFile.iter_actions()
+    else:
+        actions = artFile.actions_for_layers( layers, pen_state = True )
+    builder = SceneBuilder( artFile, layers )
+    for action in actions:
+        builder.feed( action )
+    return builder.scene( width )
+
+# Segments that fit into a window of this many pixels on each side are
+# drawn all at once, longer ones one by one
+CAPSULE_WINDOW = 8
+
+# Returns the coverage of a capsule from a to b, whose radius goes linearly
+# from ra to rb, of the pixels whose centers are dx, dy from a, with the
+# edges antialiased by the distance of the pixel centers to it. All
+# arguments are arrays that broadcast together.
+def capsuleCoverage( dx, dy, vx, vy, ra, rb ):
+    length2 = vx * vx + vy * vy
+    t = np.clip( ( dx * vx + dy * vy ) / np.where( length2 > 0.0, length2, 1.0 ), 0.0, 1.0 )
+    distance = np.hypot( dx - t * vx, dy - t * vy )
+    return np.clip( ra + ( rb - ra ) * t - distance + 0.5, 0.0, 1.0 )
+
+# Draws the coverage of a stroke into the (H, W) array coverage, whose top
+# left pixel is at left, top in the image. Each segment is drawn as a
+# capsule (see capsuleCoverage); where segments overlap, the highest
+# coverage wins. A stroke with a single point is drawn as a dot.
+def drawCapsules( coverage, xy, radius, left, top ):
+    ( height, width ) = coverage.shape
+    if len( xy ) == 1:
+        ( xy, radius ) = ( np.concatenate( ( xy, xy ) ), np.concatenate( ( radius, radius ) ) )
+    ( a, b ) = ( xy[ :-1 ], xy[ 1: ] )
+    ( ra, rb ) = ( radius[ :-1 ], radius[ 1: ] )
+    reach = np.maximum( ra, rb ) + 1.0
+    x0 = np.floor( np.minimum( a[ :, 0 ], b[ :, 0 ] ) - reach ).astype( np.int64 )
+    x1 = np.ceil( np.maximum( a[ :, 0 ], b[ :, 0 ] ) + reach ).astype( np.int64 )
+    y0 = np.floor( np.minimum( a[ :, 1 ], b[ :, 1 ] ) - reach ).astype( np.int64 )
+    y1 = np.ceil( np.maximum( a[ :, 1 ], b[ :, 1 ] ) + reach ).astype( np.int64 )
+    inside = ( x1 > left ) & ( x0 < left + width ) & ( y1 > top ) & ( y0 < top + height )
+    small = inside & ( x1 - x0 <= CAPSULE_WINDOW ) & ( y1 - y0 <= CAPSULE_WINDOW )
+
+    # the small segments, each in a window of CAPSULE_WINDOW pixels from
+    # its top left corner
+    if small.any():
+        steps = np.arange( CAPSULE_WINDOW )
+        px = x0[ small, None, None ] + steps[ None, None, : ]
+        py = y0[ small, None, None ] + steps[ None, :, None ]
+        ( sa, sb ) = ( a[ small, :, None, None ], b[ small, :, None, None ] )
+        value = capsuleCoverage( px + ( 0.5 - sa[ :, 0 ] ), py + ( 0.5 - sa[ :, 1 ] ),
+                                 sb[ :, 0 ] - sa[ :, 0 ], sb[ :, 1 ] - sa[ :, 1 ],
+                                 ra[ small, None, None ], rb[ small, None, None ] )
+        px = np.broadcast_to( px - left, value.shape )
+        py = np.broadcast_to( py - top, value.shape )
+        keep = ( value > 0.0 ) & ( px >= 0 ) & ( px < width ) & ( py >= 0 ) & ( py < height )
+        np.maximum.at( coverage, ( py[ keep ], px[ keep ] ), value[ keep ] )
+
+    for i in np.flatnonzero( inside & ~small ).tolist():
+        cx0 = max( int( x0[ i ] ) - left, 0 )
+        cx1 = min( int( x1[ i ] ) - left, width )
+        cy0 = max( int( y0[ i ] ) - top, 0 )
+        cy1 = min( int( y1[ i ] ) - top, height )
+        ( ax, ay ) = a[ i ].tolist()
+        ( bx, by ) = b[ i ].tolist()
+        dx = np.arange( cx0 + left, cx1 + left, dtype = np.float32 )[ None, : ] + ( 0.5 - ax )
+        dy = np.arange( cy0 + top, cy1 + top, dtype = np.float32 )[ :, None ] + ( 0.5 - ay )
+        region = coverage[ cy0:cy1, cx0:cx1 ]
+        np.maximum( region, capsuleCoverage( dx, dy, bx - ax, by - ay, ra[ i ], rb[ i ] ),
+                    out = region )
+
+# Renders the tile of the image with the pixel rectangle ( left, top,
+# right, bottom ) and returns it as (H, W, 4) uint8 RGBA array.
+# The strokes of each layer are composited into a premultiplied RGBA
+# buffer of the layer in file order, erasers taking away from what the
+# layer has so far, and the layers are then composited over the
+# background with their opacity.
+def renderTile( scene, rect ):
+    ( left, top, right, bottom ) = rect
+    if scene.index is None:
+        scene.buildIndex()
+    ids = np.sort( scene.index.query( rect ) )
+    canvas = np.empty( ( bottom - top, right - left, 4 ), dtype = np.float32 )
+    canvas[ : ] = scene.background
+    for ( layerIdx, layerOpacity ) in scene.layerOrder:
+        layerIds = ids[ scene.layer[ ids ] == layerIdx ]
+        if len( layerIds ) == 0:
+            continue
+        pixels = np.zeros_like( canvas )
+        for i in layerIds.tolist():
+            ( bx0, by0, bx1, by1 ) = scene.boxes[ i ].tolist()
+            x0 = max( int( math.floor( bx0 ) ), left )
+            y0 = max( int( math.floor( by0 ) ), top )
+            x1 = min( int( math.ceil( bx1 ) ), right )
+            y1 = min( int( math.ceil( by1 ) ), bottom )
+            if x0 >= x1 or y0 >= y1:
+                continue
+            coverage = np.zeros( ( y1 - y0, x1 - x0 ), dtype = np.float32 )
+            ( start, end ) = ( scene.starts[ i ], scene.starts[ i + 1 ] )
+            drawCapsules( coverage, scene.xy[ start:end ], scene.radius[ start:end ], x0, y0 )
+            alpha = ( coverage * scene.opacity[ i ] )[ :, :, None ]
+            region = pixels[ y0 - top:y1 - top, x0 - left:x1 - left ]
+            region *= 1.0 - alpha
+            if not scene.eraser[ i ]:
+                region[ :, :, :3 ] += scene.color[ i ] * alpha
+                region[ :, :, 3: ] += alpha
+        pixels *= layerOpacity
+        canvas *= 1.0 - pixels[ :, :, 3: ]
+        canvas += pixels
+
+    # PNG wants straight (not premultiplied) alpha
+    alpha = canvas[ :, :, 3: ]
+    rgb = np.divide( canvas[ :, :, :3 ], alpha, out = np.zeros_like( canvas[ :, :, :3 ] ),
+                     where = alpha > 0.0 )
+    rgba = np.concatenate( ( rgb, alpha ), axis = 2 )
+    return np.round( np.clip( rgba, 0.0, 1.0 ) * 255.0 ).astype( np.uint8 )
+
+# Returns the rectangles ( left, top, right, bottom ) of the tiles
+# covering an image of the given size.
+def tileRects( width, height, tileSize = DEFAULT_TILE_SIZE ):
+    return [ ( x, y, min( x + tileSize, width ), min( y + tileSize, height ) )
+             for y in range( 0, height, tileSize )
+             for x in range( 0, width, tileSize ) ]
+
+# The scene of a worker process, set by initTileWorker
+workerScene = None
+
+def initTileWorker( scene ):
+    global workerScene
+    workerScene = scene
+    workerScene.buildIndex()
+
+def renderWorkerTile( rect ):
+    return renderTile( workerScene, rect )
+
+# Renders the whole scene as (H, W, 4) uint8 RGBA array. The tiles are
+# rendered independently, in a pool of workers processes (which each get
+# a copy of the scene once) unless workers is 1.
+def renderScene( scene, tileSize = DEFAULT_TILE_SIZE, workers = None ):
+    image = np.empty( ( scene.height, scene.width, 4 ), dtype = np.uint8 )
+    rects = tileRects( scene.width, scene.height, tileSize )
+    workers = min( workers or os.cpu_count() or 1, len( rects ) )
+    if workers <= 1:
+        tiles = ( renderTile( scene, rect ) for rect in rects )
+        for ( ( left, top, right, bottom ), tile ) in zip( rects, tiles ):
+            image[ top:bottom, left:right ] = tile
+        return image
+    with ProcessPoolExecutor( workers, initializer = initTileWorker,
+                              initargs = ( scene, ) ) as executor:
+        tiles = executor.map( renderWorkerTile, rects )
+        for ( ( left, top, right, bottom ), tile ) in zip( rects, tiles ):
+            image[ top:bottom, left:right ] = tile
+    return image
+
+def pngChunk( kind, data ):
+    return ( struct.pack( '>I', len( data ) ) + kind + data +
+             struct.pack( '>I', zlib.crc32( kind + data ) ) )
+
+# Writes an (H, W, 4) uint8 RGBA array as PNG to the binary file object out.
+def writePng( out, rgba ):
+    ( height, width ) = rgba.shape[ :2 ]
+    # every row starts with the byte of its filter type, 0 for none
+    rows = np.zeros( ( height, width * 4 + 1 ), dtype = np.uint8 )
+    rows[ :, 1: ] = rgba.reshape( height, width * 4 )
+    out.write( b'\x89PNG\r\n\x1a\n' )
+    out.write( pngChunk( b'IHDR', struct.pack( '>IIBBBBB', width, height, 8, 6, 0, 0, 0 ) ) )
+    out.write( pngChunk( b'IDAT', zlib.compress( rows.tobytes(), 6 ) ) )
+    out.write( pngChunk( b'IEND', b'' ) )
+
+# Renders the given art file into a PNG width pixels wide, written to the
+# binary file object out. See SceneBuilder for layers and renderScene for
+# tileSize and workers.
+def exportPng( artFile, out, width = DEFAULT_WIDTH, layers = None,
+               tileSize = DEFAULT_TILE_SIZE, workers = None ):
+    scene = buildScene( artFile, width, layers )
+    writePng( out, renderScene( scene, tileSize, workers ) )
+
+
+def main( argv ):
+	parser = argparse.ArgumentParser( prog = 'strokes2png.py' )
+	parser.add_argument( 'input', help = 'input .art file' )
+	parser.add_argument( 'layers', nargs = '*', type = int, metavar = 'layer',
+		help = 'numbers of the layers to draw (default: all visible ones)' )
+	parser.add_argument( '-o', '--output', required = True, help = 'PNG file to write' )
+	parser.add_argument( '--width', type = int, default = DEFAULT_WIDTH,
+		help = 'width of the image in pixels (default: %(default)s)' )
+	parser.add_argument( '--tile-size', type = int, default = DEFAULT_TILE_SIZE,
+		help = 'size of the tiles rendered in parallel (default: %(default)s)' )
+	parser.add_argument( '-j', '--jobs', type = int, default = None,
+		help = 'number of worker processes (default: number of CPUs)' )
+	parser.add_argument( '--stream', action = 'store_true',
+		help = 'decompress the actions as they are read instead of loading them all '
+		       'first, which takes less memory but fails on files with '
+		       'back-references beyond the stream window' )
+	args = parser.parse_args( argv[ 1: ] )
+	if args.width < 1 or args.tile_size < 1:
+		parser.error( 'the width and tile size must be positive' )
+	layers = args.layers or None
+	if args.stream and layers is not None:
+		parser.error( '--stream cannot be used with a layer selection' )
+	artFile = artparser.ArtParser( args.input, stream_actions = args.stream,
+		point_arrays = True )
+	try:
+		with open( args.output, 'wb' ) as out:
+			exportPng( artFile, out, args.width, layers, args.tile_size, args.jobs )
+	finally:
+		artFile.close()
+
+if __name__ == '__main__':
+	sys.exit( main( sys.argv ) )
@@ -1,4 +1,8 @@
+import argparse
+import io
+import shutil
 import sys
+import tempfile
 import numpy as np
 import artparser
 
@@ -9,179 +13,500 @@ import artparser
 def isEqual( a, b ):
     return abs( a - b ) < 10.0e-6
 
-def buildSvg( artFile ):
-   
-    svg = '<svg xmlns="http://www.w3.org/2000/svg" version="1.1">\n'
-
-    # If the background isn't white, add a full-size rectangle of the
-    # given color
-    if not isEqual( artFile.background_color[ 0 ], 1.0 ) or \
-       not isEqual( artFile.background_color[ 1 ], 1.0 ) or \
-       not isEqual( artFile.background_color[ 2 ], 1.0 ):
-       svg += '\t<rect id="mischiefBg" width="100%%" height="100%%" style="stroke: none; fill:rgb(%f, %f, %f);"/>\n' % artFile.background_color
-    
-    # A list of strings, each holding the SVG code for one of the layers.
-    # Actions are recorded in creation sequence and not stored per-layer,
-    # so we need to go through all actions and append the corresponding code
-    # to the svg for the layer they are associated with and then combine the
-    # layers in the end.
-    layerCode = []
-    
-    # Start each layer with a g (group) tag
-    layerIdx = 0
-    for layer in artFile.layers:
-        # Add a new block of code to the list
-        # FIXME: The id attribute probably shouldn't have spaces in it, and
-        # if the layer name has any quotes in it, we're in deep trouble!
-        # But what is the correct way to export a layer name? Affinity Designer
-        # seems to use the id attribute value as a layer name.
-        layerCode.append( '\t<g id="%s" transform-origin="50%% 50%%" transform="scale(1.0 -1.0)" opacity="%f" visibility="%s" style="fill: none; stroke: black; stroke-width:1px;">\n' % (
-                layer[ "name" ],
-                layer[ "opacity" ],
-                'visible' if layer[ 'visible' ] else 'hidden'
-        ))
-        layerIdx += 1
-    
-    matrix = np.matrix(np.eye(4))
-    matrix_flat = ', '.join(str(v) for v in matrix.A1)
-    
-    # Pen state
-    penColor = [ 0.0, 0.0, 0.0 ]
-    penAlpha = 1.0
-    penSize  = 1.0
-    isEraser = False
-    
-    # Go through all the actions in the mischief file
-    for action in artFile.actions:
+# How many characters of SVG code a layer keeps in memory before the rest
+# goes to a temporary file
+LAYER_SPOOL_SIZE = 1 << 22
+
+# Returns the x and y coordinates of a list of points as (N, 2) array.
+def pointsXY( points ):
+    if isinstance( points, artparser.PointList ):
+        return points.array[ :, :2 ].astype( np.float64 )
+    return np.array( [ ( point['x'], point['y'] ) for point in points ],
+                     dtype = np.float64 ).reshape( -1, 2 )
+
+# Formats an array of coordinates that were multiplied by 10 ** precision
+# and rounded to integers as the numbers they stand for, with at most
+# precision decimals and no trailing zeros. Returns a list of strings.
+def formatFixed( values, precision ):
+    if precision == 0:
+        return [ str( v ) for v in values.tolist() ]
+    text = np.char.mod( '%%.%df' % precision, values / 10.0 ** precision )
+    return np.char.rstrip( np.char.rstrip( text, '0' ), '.' ).tolist()
+
+# Returns the part of a 4x4 matrix that maps row vectors (x, y, 0, 1) to
+# the transformed x and y as a 4x2 matrix, or None if the matrix isn't
+# affine in x and y (it has a perspective part). This is the convention
+# of the matrix3d CSS the matrices are otherwise written as: CSS reads
+# the row-major values as columns and applies them to column vectors.
+def affine2d( matrix ):
+    m = np.asarray( matrix, dtype = np.float64 )
+    if m[ 0, 3 ] != 0.0 or m[ 1, 3 ] != 0.0 or m[ 3, 3 ] == 0.0:
+        return None
+    return m[ :, :2 ] / m[ 3, 3 ]
+
+# Builds the d attribute of a path through the given (N, 2) points,
+# as a moveto and relative lineto commands. The points are rounded to
+# precision decimals first and the differences are taken between the
+# rounded points, so the rounding errors don't add up along the path.
+# Points that round to the previous point are left out, but a stroke that
+# rounds to a single point keeps one zero-length lineto, as a bare moveto
+# draws nothing (while the round line cap draws a zero-length line as a dot).
+def pathData( xy, precision ):
+    if len( xy ) == 0:
+        return ''
+    fixed = np.round( xy * 10.0 ** precision ).astype( np.int64 )
+    deltas = np.diff( fixed, axis = 0 )
+    deltas = deltas[ deltas.any( axis = 1 ) ]
+    if len( deltas ) == 0:
+        deltas = np.zeros( ( 1, 2 ), dtype = np.int64 )
+    numbers = formatFixed( np.concatenate( ( fixed[ :1 ], deltas ) ).ravel(), precision )
+    d = 'M' + numbers[ 0 ] + ' ' + numbers[ 1 ]
+    if len( numbers ) > 2:
+        d += 'l' + ' '.join( numbers[ 2: ] )
+    return d
+
+# Writes the SVG for an art file to the file object out as the actions are
+# fed to it one by one, so they don't all have to be in memory.
+# Actions are recorded in creation sequence and not stored per-layer,
+# so the code for each layer goes into a buffer of its own (which spills
+# to a temporary file when it gets large), and finish writes the layers
+# into the output in layer order.
+# If layers is given, only those layers (a list of layer numbers) are
+# exported.
+# Strokes are written as polylines with the points at full precision,
+# or if precision is given, as paths with relative coordinates rounded to
+# that many decimals, which is a lot smaller.
+# With pretransform, the pen matrix is applied to the points of strokes
+# here, with the stroke width scaled by the square root of its area
+# scale, and given to rects and ellipses as a 2D transform attribute.
+# matrix3d is then only used for perspective matrices.
+# With simplify, strokes are simplified (see artparser.rdp_mask) so they
+# stay within that distance of the original in output units.
+# With minSize, strokes whose size including the pen width is below that
+# in output units are left out.
+# With shareStyles, each distinct style gets a CSS class in a <style>
+# block instead of being repeated on every element, and consecutive
+# elements of a layer with the same style are put into a <g> of that
+# class. Rects and ellipses then take their own placement from a
+# transform attribute.
+class SvgExporter:
+    def __init__( self, artFile, out, layers = None, precision = None,
+                  shareStyles = False, pretransform = False, simplify = None,
+                  minSize = None ):
+        if precision is not None and precision < 0:
+            raise ValueError( 'precision must not be negative' )
+        if simplify is not None and simplify < 0:
+            raise ValueError( 'simplify must not be negative' )
+        self.artFile = artFile
+        self.out = out
+        self.layers = layers
+        self.precision = precision
+        self.shareStyles = shareStyles
+        self.pretransform = pretransform
+        self.simplify = simplify
+        self.minSize = minSize
+
+        out.write( '<svg xmlns="http://www.w3.org/2000/svg" version="1.1">\n' )
+
+        # If the background isn't white, add a full-size rectangle of the
+        # given color
+        if not isEqual( artFile.background_color[ 0 ], 1.0 ) or \
+           not isEqual( artFile.background_color[ 1 ], 1.0 ) or \
+           not isEqual( artFile.background_color[ 2 ], 1.0 ):
+           out.write( '\t<rect id="mischiefBg" width="100%%" height="100%%" style="stroke: none; fill:rgb(%f, %f, %f);"/>\n' % artFile.background_color )
+
+        # One buffer for the SVG code of each layer
+        self.layerCode = [ tempfile.SpooledTemporaryFile( LAYER_SPOOL_SIZE, 'w+' )
+                           for layer in artFile.layers ]
+
+        # CSS -> class name, and the class of the open <g> of each layer
+        self.styleClasses = {}
+        self.layerClass = [ None ] * len( artFile.layers )
+
+        self.matrix = np.matrix(np.eye(4))
+        self.matrix_flat = ', '.join(str(v) for v in self.matrix.A1)
+        self.setAffine()
+
+        # Pen state
+        self.penColor = [ 0.0, 0.0, 0.0 ]
+        self.penAlpha = 1.0
+        self.penSize  = 1.0
+        self.isEraser = False
+
+    # Adds the code for a single action. The actions have to be fed in
+    # the order they appear in the file.
+    # For a stroke, xy can give its points as array in the coordinates the
+    # exporter writes them in (so with pretransform, already transformed),
+    # to use instead of the action's points; the points as written (before
+    # formatting) are left in strokeXY. strokeDropped tells whether the
+    # stroke was left out for being smaller than minSize.
+    def feed( self, action, xy = None ):
+        self.strokeXY = None
+        self.strokeDropped = False
         if action['action_name'] == 'paste_layer':
-            print('<!-- paste layer used, the result may be invalid! -->')
+            self.write( action, '\t\t<!-- paste layer used, the result may be invalid! -->\n' )
         # Set pen matrix action
         if action['action_id'] == 51:
-            layer_matrix = np.matrix(artFile.layers[action['layer']]['matrix'])
+            layer_matrix = np.matrix(self.artFile.layers[action['layer']]['matrix'])
             pen_matrix   = np.matrix(action['matrix'])
-            matrix       = layer_matrix * pen_matrix
-            matrix_flat = ', '.join(str(v) for v in matrix.A1)
-        
+            self.matrix      = layer_matrix * pen_matrix
+            self.matrix_flat = ', '.join(str(v) for v in self.matrix.A1)
+            self.setAffine()
+
         # Stroke Action
         elif action[ 'action_id' ] == 1 or action['action_name'] == 'polyline':
-            layerIdx = action[ 'layer' ]
-            assert( layerCode[ layerIdx ] != None )
+            # The stroke points as array, where they need any processing
+            if xy is None and ( self.affine is not None or self.simplify is not None or
+                                self.minSize is not None ):
+                xy = pointsXY( action[ 'points' ] )
+                if self.affine is not None:
+                    xy = np.column_stack( ( xy, np.zeros( len( xy ) ), np.ones( len( xy ) ) ) ) @ self.affine
+            # Output units per unit of xy; the matrix3d transform still
+            # scales the points unless it was applied above. The pen width
+            # is in document units either way.
+            pointScale = 1.0 if self.affine is not None else self.outputScale
+
+            if self.minSize is not None:
+                extent = np.ptp( xy, axis = 0 ).max() if len( xy ) else 0.0
+                if extent * pointScale + self.penSize * self.outputScale < self.minSize:
+                    self.strokeDropped = True
+                    return
+
+            if self.simplify is not None and pointScale > 0.0:
+                xy = xy[ artparser.rdp_mask( xy, self.simplify / pointScale ) ]
 
             # CSS that goes into the polyline's style attribute
             css = ''
-            
-            if isEraser:
+
+            if self.isEraser:
                 css += 'stroke: white; '
             else:
-                css += 'stroke: rgb(%f, %f, %f); ' % ( penColor[ 0 ], penColor[ 1 ], penColor[ 2 ] )
-        
+                css += 'stroke: rgb(%f, %f, %f); ' % ( self.penColor[ 0 ], self.penColor[ 1 ], self.penColor[ 2 ] )
+
             # If pen size is not one (the default we set in the <g> tag),
             # specify the size
+            penSize = self.penSize
+            if self.affine is not None:
+                penSize *= self.outputScale
             if not isEqual( penSize, 1.0 ):
                 css += 'stroke-width: %fpx; ' % penSize
-        
+
             # If pen opacity is not 100%, specify that in the CSS
-            if not isEqual( penAlpha, 1.0 ):
-                css += 'stroke-opacity: %f; ' % penAlpha
-        
+            if not isEqual( self.penAlpha, 1.0 ):
+                css += 'stroke-opacity: %f; ' % self.penAlpha
+
             css += 'stroke-linejoin: round; '
             css += 'stroke-linecap: round; '
-            css += 'transform: matrix3d({}); '.format(matrix_flat)
+            if self.affine is None:
+                css += 'transform: matrix3d({}); '.format(self.matrix_flat)
 
             # If there is any CSS to add, set this to 'style="..."', otherwise
             # set it to an empty string. That way we don't add an empty style
             # attribute where there is nothing to set.
             styleAttr = ''
-            if len(css) > 0:
+            if self.shareStyles:
+                self.useStyle( action, css )
+            elif len(css) > 0:
                 styleAttr = 'style="%s" ' % css
-            
-            layerCode[ layerIdx ] += '\t\t<polyline %spoints="' % styleAttr
-            
+
             # Output stroke points
-            for point in action[ 'points' ]:
-                layerCode[ layerIdx ] += str( point['x'] ) + "," + str( point['y'] ) + " "
+            self.strokeXY = xy
+            if self.precision is None:
+                if xy is None:
+                    points = ''.join([ str( point['x'] ) + "," + str( point['y'] ) + " "
+                                       for point in action[ 'points' ] ])
+                else:
+                    points = ''.join([ str( x ) + "," + str( y ) + " " for ( x, y ) in xy.tolist() ])
+                self.write( action, '\t\t<polyline %spoints="%s" />\n' % ( styleAttr, points ) )
+            else:
+                if xy is None:
+                    xy = pointsXY( action[ 'points' ] )
+                d = pathData( xy, self.precision )
+                self.write( action, '\t\t<path %sd="%s" />\n' % ( styleAttr, d ) )
 
-            layerCode[ layerIdx ] += '" />\n'
-    
         # Set Pen Color Action
         elif action[ 'action_id' ] == 0x35:
-            penColor = action[ 'color' ]
-        
+            self.penColor = action[ 'color' ]
+
         # Set Pen Properties Action
         elif action[ 'action_id' ] == 0x34:
-            penSize  = action[ 'size'    ]
-            penAlpha = action[ 'opacity' ]
+            self.penSize  = action[ 'size'    ]
+            self.penAlpha = action[ 'opacity' ]
 
         elif action['action_name'] == 'is_eraser':
-            isEraser = action['is_eraser']
+            self.isEraser = action['is_eraser']
 
         elif action['action_name'] == 'rect':
-            layerIdx = action[ 'layer' ]
             (x, y) = (action['x'], action['y'])
             (w, h) = (action['w'], action['h'])
             angle = action['angle']
+            penColor = self.penColor
             style = "stroke: rgb({}, {}, {});".format(penColor[0], penColor[1], penColor[2]);
-            style += 'border-radius: {}px; '.format(penSize)
-            style += 'stroke-width: {}px; '.format(penSize)
-            style += 'stroke-opacity: {}; '.format(penAlpha)
+            style += 'border-radius: {}px; '.format(self.penSize)
+            style += 'stroke-width: {}px; '.format(self.penSize)
+            style += 'stroke-opacity: {}; '.format(self.penAlpha)
             style += 'stroke-linejoin: round; '
             style += "transform-origin: 0 0;"
 
             tx = -w / 2.0
             ty = -h / 2.0
+            if self.shareStyles or self.pretransform:
+                self.writeShape( action,
+                    '<rect x="0" y="0" width="{}" height="{}"'.format(w, h), style,
+                    'translate({}, {}) rotate({}) translate({}, {})'.format(x, y, angle, tx, ty))
+                return
             style += ("transform: matrix3d({}) translate({}px, {}px) rotate({}deg) translate({}px, {}px)"
-                    .format(matrix_flat, x, y, angle, tx, ty))
-            layerCode[layerIdx] += (
+                    .format(self.matrix_flat, x, y, angle, tx, ty))
+            self.write( action,
                 '\t\t<rect x="0" y="0" width="{}" height="{}" style="{}" />\n'
                     .format(w, h, style))
 
         elif action['action_name'] == 'ellipse':
-            layerIdx = action[ 'layer' ]
             (cx, cy) = (action['cx'], action['cy'])
             (rx, ry) = (action['rx'], action['ry'])
             angle = action['angle']
-            matrix_flat = ', '.join(str(v) for v in matrix.A1)
+            penColor = self.penColor
             style = "stroke: rgb({}, {}, {});".format(penColor[0], penColor[1], penColor[2]);
-            style += 'border-radius: {}px; '.format(penSize)
-            style += 'stroke-width: {}px; '.format(penSize)
-            style += 'stroke-opacity: {}; '.format(penAlpha)
+            style += 'border-radius: {}px; '.format(self.penSize)
+            style += 'stroke-width: {}px; '.format(self.penSize)
+            style += 'stroke-opacity: {}; '.format(self.penAlpha)
             style += 'stroke-linejoin: round; '
             style += "transform-origin: 0 0;"
 
             tx = -rx / 2.0
             ty = -ry / 2.0
+            if self.shareStyles or self.pretransform:
+                self.writeShape( action,
+                    '<ellipse cx="0" cy="0" rx="{}" ry="{}"'.format(rx, ry), style,
+                    'translate({}, {}) rotate({}) translate({}, {})'.format(cx, cy, angle, tx, ty))
+                return
             style += ("transform: matrix3d({}) translate({}px, {}px) rotate({}deg) translate({}px, {}px)"
-                    .format(matrix_flat, cx, cy, angle, tx, ty))
-            layerCode[layerIdx] += (
+                    .format(self.matrix_flat, cx, cy, angle, tx, ty))
+            self.write( action,
                 '\t\t<ellipse cx="0" cy="0" rx="{}" ry="{}" style="{}" />\n'
                     .format(rx, ry, style))
 
-        elif action['action_name'] == 'pen_matrix':
-            layerIdx = action[ 'layer' ]
-            (cx, cy) = (action['cx'], action['cy'])
-            (rx, ry) = (action['rx'], action['ry'])
-
         else:
             pass
 
+    # Updates affine for the current pen matrix, if it is applied here
+    # (otherwise, affine is None), and outputScale, the square root of the
+    # area scale of the matrix
+    def setAffine( self ):
+        self.affine = None
+        if self.pretransform:
+            self.affine = affine2d( self.matrix )
+        if self.affine is not None:
+            self.outputScale = abs( np.linalg.det( self.affine[ :2 ] ) ) ** 0.5
+        else:
+            self.outputScale = abs( np.linalg.det( np.asarray( self.matrix )[ :2, :2 ] ) ) ** 0.5
+
+    # Writes a rect or ellipse when shareStyles or pretransform is set.
+    # element is the start of its tag, style its CSS without the transform
+    # and placement the transforms moving it into place.
+    def writeShape( self, action, element, style, placement ):
+        if self.affine is not None:
+            affine = self.affine
+            transform = 'matrix({}, {}, {}, {}, {}, {}) {}'.format(
+                affine[ 0, 0 ], affine[ 0, 1 ], affine[ 1, 0 ], affine[ 1, 1 ],
+                affine[ 3, 0 ], affine[ 3, 1 ], placement )
+        else:
+            style += "transform: matrix3d({});".format(self.matrix_flat)
+            transform = placement
+        styleAttr = ''
+        if self.shareStyles:
+            self.useStyle( action, style )
+        else:
+            styleAttr = ' style="{}"'.format(style)
+        self.write( action, '\t\t{}{} transform="{}" />\n'.format(element, styleAttr, transform) )
+
+    # Appends code to the buffer of the layer of the action, unless that
+    # layer isn't exported
+    def write( self, action, code ):
+        layerIdx = action[ 'layer' ]
+        if self.layers is None or layerIdx in self.layers:
+            self.layerCode[ layerIdx ].write( code )
+
+    # Makes the next element of the action's layer use the given CSS, by
+    # starting a <g> with its class unless the layer already has that one
+    # open
+    def useStyle( self, action, css ):
+        layerIdx = action[ 'layer' ]
+        if self.layers is not None and layerIdx not in self.layers:
+            return
+        styleClass = self.styleClasses.get( css )
+        if styleClass is None:
+            styleClass = 's%d' % len( self.styleClasses )
+            self.styleClasses[ css ] = styleClass
+        if self.layerClass[ layerIdx ] != styleClass:
+            if self.layerClass[ layerIdx ] is not None:
+                self.layerCode[ layerIdx ].write( '\t\t</g>\n' )
+            self.layerCode[ layerIdx ].write( '\t\t<g class="%s">\n' % styleClass )
+            self.layerClass[ layerIdx ] = styleClass
+
     # Now that we built the code for the individual layers,
-    # combine them into the final SVG
-    for code in layerCode:
-        # FIXME: This won't change the code for the layer since "code" is a
-        # temporary copy. Doesn't matter since we add that temporary copy to the
-        # output SVG, but I should probably learn Python at some point and
-        # figure out how to actually do this correctly.
-        code += "\t</g>\n"
-        svg += code
-    
-    svg += "</svg>\n"
-    
-    return svg
-    
-    
+    # combine them into the final SVG. Layers missing from the layer order
+    # go last.
+    def finish( self ):
+        if self.styleClasses:
+            self.out.write( '\t<style>\n' )
+            for ( css, styleClass ) in self.styleClasses.items():
+                self.out.write( '\t\t.%s { %s }\n' % ( styleClass, css ) )
+            self.out.write( '\t</style>\n' )
+
+        order = [ layerIdx for layerIdx in self.artFile.layer_order
+                  if 0 <= layerIdx < len( self.layerCode ) ]
+        order += sorted( set( range( len( self.layerCode ) ) ) - set( order ) )
+        for layerIdx in order:
+            if self.layers is not None and layerIdx not in self.layers:
+                continue
+            layer = self.artFile.layers[ layerIdx ]
+            # Start each layer with a g (group) tag
+            # FIXME: The id attribute probably shouldn't have spaces in it, and
+            # if the layer name has any quotes in it, we're in deep trouble!
+            # But what is the correct way to export a layer name? Affinity Designer
+            # seems to use the id attribute value as a layer name.
+            self.out.write( '\t<g id="%s" transform-origin="50%% 50%%" transform="scale(1.0 -1.0)" opacity="%f" visibility="%s" style="fill: none; stroke: black; stroke-width:1px;">\n' % (
+                    layer[ "name" ],
+                    layer[ "opacity" ],
+                    'visible' if layer[ 'visible' ] else 'hidden'
+            ))
+            code = self.layerCode[ layerIdx ]
+            code.seek( 0 )
+            shutil.copyfileobj( code, self.out )
+            if self.layerClass[ layerIdx ] is not None:
+                self.out.write( "\t\t</g>\n" )
+            self.out.write( "\t</g>\n" )
+        self.out.write( "</svg>\n" )
+        self.close()
+
+    def close( self ):
+        for code in self.layerCode:
+            code.close()
+
+# Writes the SVG for the given art file to the file object out. If layers
+# is given, only those layers (a list of layer numbers) are exported, and
+# only their actions (plus the ones setting the pen state) are visited.
+# See SvgExporter for precision, shareStyles, pretransform and simplify.
+def exportSvg( artFile, out, layers = None, precision = None, shareStyles = False,
+               pretransform = False, simplify = None ):
+    if layers is None:
+        actions = artFile.iter_actions()
+    else:
+        actions = artFile.actions_for_layers( layers, pen_state = True )
+
+    exporter = SvgExporter( artFile, out, layers, precision, shareStyles, pretransform,
+                            simplify )
+    try:
+        # Go through all the (selected) actions in the mischief file
+        for action in actions:
+            exporter.feed( action )
+        exporter.finish()
+    finally:
+        exporter.close()
+
+# Zoom levels written by exportSvgLevels by default
+LEVEL_SCALES = ( 1.0, 1.0 / 4, 1.0 / 16 )
+
+# Writes the SVG for the given art file at several levels of detail, in a
+# single pass over the actions, so their points are decoded only once.
+# outs is a list of file objects, one for each of scales. At zoom level
+# scale, one output unit takes scale pixels: strokes are simplified to
+# half a pixel, and strokes smaller than a pixel are left out at levels
+# below 1. The other arguments are as for exportSvg.
+# Each level is simplified from the points of the level before it if that
+# one has a finer tolerance, by the difference between the two tolerances,
+# so the points drift at most half a pixel from the original in total.
+# A stroke left out of a level for being too small is left out of the
+# levels simplified from it as well, as it is smaller still there.
+def exportSvgLevels( artFile, outs, scales = LEVEL_SCALES, layers = None,
+                     precision = None, shareStyles = False, pretransform = False ):
+    if layers is None:
+        actions = artFile.iter_actions()
+    else:
+        actions = artFile.actions_for_layers( layers, pen_state = True )
+
+    exporters = []
+    chained = []
+    try:
+        previous = None
+        for ( out, scale ) in zip( outs, scales ):
+            tolerance = 0.5 / scale
+            chained.append( previous is not None and tolerance >= previous )
+            exporters.append( SvgExporter( artFile, out, layers, precision, shareStyles,
+                                           pretransform,
+                                           tolerance - previous if chained[ -1 ] else tolerance,
+                                           1.0 / scale if scale < 1.0 else None ) )
+            previous = tolerance
+        for action in actions:
+            xy = None
+            dropped = False
+            for ( exporter, fromPrevious ) in zip( exporters, chained ):
+                if fromPrevious and dropped:
+                    # strokes don't change the pen state, so nothing is missed
+                    continue
+                exporter.feed( action, xy if fromPrevious else None )
+                ( xy, dropped ) = ( exporter.strokeXY, exporter.strokeDropped )
+        for exporter in exporters:
+            exporter.finish()
+    finally:
+        for exporter in exporters:
+            exporter.close()
+
+# Builds the SVG for the given art file and returns it as a string, see
+# exportSvg.
+def buildSvg( artFile, layers = None, precision = None, shareStyles = False,
+              pretransform = False, simplify = None ):
+    out = io.StringIO()
+    exportSvg( artFile, out, layers, precision, shareStyles, pretransform, simplify )
+    return out.getvalue()
+
+
 def main( argv ):
-	artFile = artparser.ArtParser( argv[ 1 ] )
-	print(buildSvg( artFile ))
+	parser = argparse.ArgumentParser( prog = 'strokes2svg.py' )
+	parser.add_argument( 'input', help = 'input .art file' )
+	parser.add_argument( 'layers', nargs = '*', type = int, metavar = 'layer',
+		help = 'numbers of the layers to export (default: all)' )
+	parser.add_argument( '--precision', type = int,
+		help = 'write strokes as paths with this many decimals' )
+	parser.add_argument( '--share-styles', action = 'store_true',
+		help = 'put the styles into shared CSS classes' )
+	parser.add_argument( '--pretransform', action = 'store_true',
+		help = 'apply the pen matrices to the coordinates instead of using matrix3d' )
+	parser.add_argument( '--simplify', type = float, metavar = 'TOLERANCE',
+		help = 'simplify strokes to this tolerance in output units (not with --levels, '
+		       'which simplifies each level to half a pixel)' )
+	parser.add_argument( '--levels', metavar = 'PREFIX',
+		help = 'write PREFIX_1.svg, PREFIX_4.svg and PREFIX_16.svg for zoom levels '
+		       '1, 1/4 and 1/16 instead of a single SVG to stdout' )
+	parser.add_argument( '--stream', action = 'store_true',
+		help = 'decompress and convert the actions as they are read instead of '
+		       'loading them all first, which takes less memory but fails on files '
+		       'with back-references beyond the stream window' )
+	args = parser.parse_args( argv[ 1: ] )
+	layers = args.layers or None
+	if args.stream and layers is not None:
+		parser.error( '--stream cannot be used with a layer selection' )
+	if args.levels is not None and args.simplify is not None:
+		parser.error( '--simplify cannot be used with --levels' )
+	artFile = artparser.ArtParser( args.input, stream_actions = args.stream,
+		point_arrays = args.precision is not None or args.simplify is not None
+			or args.levels is not None )
+	try:
+		if args.levels is not None:
+			outs = [ open( '%s_%d.svg' % ( args.levels, round( 1.0 / scale ) ), 'w' )
+			         for scale in LEVEL_SCALES ]
+			try:
+				exportSvgLevels( artFile, outs, LEVEL_SCALES, layers, args.precision,
+					args.share_styles, args.pretransform )
+			finally:
+				for out in outs:
+					out.close()
+		else:
+			exportSvg( artFile, sys.stdout, layers, args.precision, args.share_styles,
+				args.pretransform, args.simplify )
+	finally:
+		artFile.close()
 
 if __name__ == '__main__':
 	sys.exit( main( sys.argv ) )
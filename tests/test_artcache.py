@@ -0,0 +1,206 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from test_artparser import SAMPLE_FILES, read_payload
+
+import artcache
+import artparser
+
+
+class ArtCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def copy_sample(self, name, sample=SAMPLE_FILES[-1]):
+        path = os.path.join(self.directory.name, name)
+        shutil.copyfile(sample, path)
+        return path
+
+    def get_from_threads(self, cache, fname, count=4):
+        results = [None] * count
+        def run(i):
+            try:
+                results[i] = cache.get(fname)
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def blocking_parser(self, release, calls, error=None):
+        def parse(fname, **kwargs):
+            calls.append(fname)
+            release.wait(5)
+            if error is not None:
+                raise error
+            return artparser.ArtParser(fname, **kwargs)
+        return parse
+
+    def test_concurrent_gets_parse_once(self):
+        fname = self.copy_sample('a.art')
+        (release, calls) = (threading.Event(), [])
+        cache = artcache.ArtCache(parser=self.blocking_parser(release, calls))
+        threading.Timer(0.2, release.set).start()
+        results = self.get_from_threads(cache, fname)
+        self.assertEqual(len(calls), 1)
+        self.assertIsInstance(results[0], artparser.ArtParser)
+        for result in results:
+            self.assertIs(result, results[0])
+        self.assertIs(cache.get(fname), results[0])
+        self.assertEqual(len(calls), 1)
+
+    def test_parse_error_reaches_all_waiters(self):
+        fname = self.copy_sample('a.art')
+        (release, calls) = (threading.Event(), [])
+        error = Exception('bad file')
+        cache = artcache.ArtCache(parser=self.blocking_parser(release, calls, error))
+        threading.Timer(0.2, release.set).start()
+        results = self.get_from_threads(cache, fname)
+        self.assertEqual(len(calls), 1)
+        for result in results:
+            self.assertIs(result, error)
+        self.assertEqual((len(cache.documents), len(cache.pending), cache.total_bytes), (0, 0, 0))
+        # the error is not cached, the next get parses again
+        with self.assertRaises(Exception):
+            cache.get(fname)
+        self.assertEqual(len(calls), 2)
+
+    def test_changed_file_drops_stale_entry(self):
+        fname = self.copy_sample('a.art')
+        cache = artcache.ArtCache()
+        first = cache.get(fname)
+        st = os.stat(fname)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        second = cache.get(fname)
+        self.assertIsNot(second, first)
+        self.assertEqual(len(cache.documents), 1)
+        with open(fname, 'ab') as file:
+            file.write(b'\0')
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        third = cache.get(fname)
+        self.assertIsNot(third, second)
+        self.assertEqual(list(cache.documents.values()), [(third, artcache.estimate_footprint(third))])
+        self.assertEqual(cache.total_bytes, artcache.estimate_footprint(third))
+
+    def test_evicts_least_recently_used(self):
+        names = [self.copy_sample(name) for name in ('a.art', 'b.art', 'c.art')]
+        footprint = artcache.estimate_footprint(artparser.ArtParser(names[0]))
+        cache = artcache.ArtCache(max_bytes=2 * footprint)
+        (a, b) = (cache.get(names[0]), cache.get(names[1]))
+        self.assertIs(cache.get(names[0]), a)
+        cache.get(names[2])
+        self.assertEqual([key[0] for key in cache.documents], [names[0], names[2]])
+        self.assertEqual(cache.total_bytes, 2 * footprint)
+        self.assertIs(cache.get(names[0]), a)
+        self.assertIsNot(cache.get(names[1]), b)
+
+    def test_lazy_footprint(self):
+        # the lazy index takes 20 bytes per action
+        art = artparser.ArtParser(SAMPLE_FILES[-1], lazy_actions=True)
+        rest = len(art.data) + sum(len(image['raw']) for image in art.images)
+        self.assertGreaterEqual(artcache.estimate_footprint(art) - rest, 20 * art.action_count)
+
+
+class PayloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache_dir = os.path.join(self.directory.name, 'cache')
+
+    def copy_sample(self, name, sample=SAMPLE_FILES[-1]):
+        path = os.path.join(self.directory.name, name)
+        shutil.copyfile(sample, path)
+        return path
+
+    def unpack(self, cache, fname):
+        '''
+        Returns the bytes cache.unpack gives for fname, and whether it
+        decompressed the payload.
+        '''
+        calls = []
+        def unpack(payload, progress=None):
+            calls.append(payload)
+            return artparser.mischief_unpack(payload, progress)
+        with mock.patch.object(artcache, 'mischief_unpack', unpack):
+            data = cache.unpack(fname, read_payload(fname))
+        result = bytes(data)
+        if hasattr(data, 'close'):
+            data.close()
+        return (result, bool(calls))
+
+    def entries(self):
+        return sorted(name for name in os.listdir(self.cache_dir)
+                      if name.endswith(artcache.ENTRY_SUFFIX))
+
+    def test_miss_then_hit(self):
+        cache = artcache.PayloadCache(self.cache_dir)
+        for fname in SAMPLE_FILES:
+            with self.subTest(fname=os.path.basename(fname)):
+                expected = bytes(artparser.mischief_unpack(read_payload(fname)))
+                self.assertEqual(self.unpack(cache, fname), (expected, True))
+                self.assertEqual(self.unpack(cache, fname), (expected, False))
+
+    def test_damaged_entry_is_rebuilt(self):
+        fname = SAMPLE_FILES[-1]
+        cache = artcache.PayloadCache(self.cache_dir)
+        (expected, _) = self.unpack(cache, fname)
+        (entry,) = self.entries()
+        path = os.path.join(self.cache_dir, entry)
+        for damaged in (expected[:-1], expected + b'\0', b''):
+            with self.subTest(length=len(damaged)):
+                with open(path, 'wb') as file:
+                    file.write(damaged)
+                self.assertEqual(self.unpack(cache, fname), (expected, True))
+                self.assertEqual(os.path.getsize(path), len(expected))
+                self.assertEqual(self.unpack(cache, fname), (expected, False))
+
+    def test_evicts_least_recently_used(self):
+        names = [self.copy_sample(name, sample) for (name, sample)
+                 in zip(('a.art', 'b.art', 'c.art'), SAMPLE_FILES[1:])]
+        sizes = [len(self.unpack(artcache.PayloadCache(self.cache_dir), name)[0])
+                 for name in names]
+        artcache.PayloadCache(self.cache_dir).clear()
+        cache = artcache.PayloadCache(self.cache_dir, max_bytes=max(sizes) * 2)
+        for name in (names[0], names[1], names[0], names[2]):
+            self.unpack(cache, name)
+            # the use times of the entries have to differ
+            time.sleep(0.01)
+        self.assertEqual(len(self.entries()), 2)
+        self.assertFalse(self.unpack(cache, names[0])[1])
+        self.assertFalse(self.unpack(cache, names[2])[1])
+        self.assertTrue(self.unpack(cache, names[1])[1])
+
+    def test_stat_and_hash_keys(self):
+        fname = self.copy_sample('a.art')
+        copy = self.copy_sample('b.art')
+        by_stat = artcache.PayloadCache(os.path.join(self.cache_dir, 'stat'), key='stat')
+        by_hash = artcache.PayloadCache(os.path.join(self.cache_dir, 'hash'), key='hash')
+        for cache in (by_stat, by_hash):
+            self.assertTrue(self.unpack(cache, fname)[1])
+        # a copy has the same payload, but a different path
+        self.assertTrue(self.unpack(by_stat, copy)[1])
+        self.assertFalse(self.unpack(by_hash, copy)[1])
+        # touching the file changes its modification time, but not its payload
+        st = os.stat(fname)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertTrue(self.unpack(by_stat, fname)[1])
+        self.assertFalse(self.unpack(by_hash, fname)[1])
+        # a different payload under the same name and modification time
+        shutil.copyfile(SAMPLE_FILES[1], fname)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        expected = bytes(artparser.mischief_unpack(read_payload(SAMPLE_FILES[1])))
+        self.assertEqual(self.unpack(by_hash, fname), (expected, True))
+        self.assertRaises(Exception, artcache.PayloadCache, self.cache_dir, key='name')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,545 @@
+import asyncio
+import glob
+import os
+import struct
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import artparser
+
+# the example file of the Rust parser, and small synthetic files with
+# strokes, shapes, images and pins
+SAMPLE_FILES = [os.path.join(ROOT, 'artparser-rs', 'examples', 'empty.art')] + \
+    sorted(glob.glob(os.path.join(ROOT, 'tests', 'data', '*.art')))
+
+
+def read_payload(fname):
+    '''
+    Returns the compressed payload of an .art file as bytes.
+    '''
+    art = artparser.ArtParser.__new__(artparser.ArtParser)
+    with artparser.map_file(fname) as fd:
+        with art.read_file_header(fd) as payload:
+            return bytes(payload)
+
+
+class DecoderTest(unittest.TestCase):
+    def test_matches_reference_decoder(self):
+        for fname in SAMPLE_FILES:
+            with self.subTest(fname=os.path.basename(fname)):
+                payload = read_payload(fname)
+                expected = artparser.mischief_unpack_reference(payload)
+                self.assertEqual(bytes(artparser.mischief_unpack(payload)), bytes(expected))
+
+    def test_truncated_input(self):
+        # a payload cut short fails as soon as the input runs out, even if
+        # it claims a large output
+        payload = read_payload(SAMPLE_FILES[-1])
+        truncated = struct.pack('<I', 50 << 20) + payload[4:69]
+        start = time.monotonic()
+        with self.assertRaisesRegex(Exception, 'ends prematurely'):
+            artparser.mischief_unpack(truncated)
+        self.assertLess(time.monotonic() - start, 5.0)
+
+    def test_stream_matches_full_decode(self):
+        for fname in SAMPLE_FILES:
+            payload = read_payload(fname)
+            expected = bytes(artparser.mischief_unpack(payload))
+            for (chunk_size, window) in ((0x100, len(expected)), (0x1000, None), (0x10000, 1 << 24)):
+                with self.subTest(fname=os.path.basename(fname), chunk_size=chunk_size, window=window):
+                    chunks = artparser.mischief_unpack_stream(payload, chunk_size, window)
+                    self.assertEqual(b''.join(chunks), expected)
+            # the smallest window that works still gives the right output,
+            # while discarding all output further back
+            (low, high) = (1, max(len(expected), 1))
+            while low < high:
+                middle = (low + high) // 2
+                try:
+                    b''.join(artparser.mischief_unpack_stream(payload, 0x100, middle))
+                    high = middle
+                except artparser.DiscardedOutputError:
+                    low = middle + 1
+            with self.subTest(fname=os.path.basename(fname), window=low):
+                output = b''.join(artparser.mischief_unpack_stream(payload, 0x100, low))
+                self.assertEqual(output, expected)
+
+    def test_stream_window(self):
+        payload = read_payload(SAMPLE_FILES[-1])
+        with self.assertRaises(ValueError):
+            artparser.mischief_unpack_stream(payload, window=0)
+        with self.assertRaisesRegex(artparser.DiscardedOutputError, 'window of 1 bytes'):
+            b''.join(artparser.mischief_unpack_stream(payload, 0x100, window=1))
+
+
+def pack_stroke(first, deltas):
+    '''
+    Returns the bytes of stroke points: the absolute point first (x, y,
+    p) followed by packed (dx, dy, pressure) deltas, where dx and dy are
+    in 1/32 units and given as (sign, magnitude).
+    '''
+    data = struct.pack('<3f', *first)
+    for ((sx, dx), (sy, dy), pressure) in deltas:
+        bits = dx | (sx << 14) | (dy << 15) | (sy << 29) | ((pressure & 3) << 30)
+        data += struct.pack('<IB', bits, pressure >> 2)
+    return data
+
+
+class StrokePointsTest(unittest.TestCase):
+    @unittest.skipIf(artparser.np is None, 'the vectorized decoder requires numpy')
+    def test_vectorized_matches_loop(self):
+        np = artparser.np
+        rng = np.random.default_rng(5)
+        edge_cases = [((1, 0), (1, 0), 0x3ff), ((0, 0), (0, 0), 0), ((0, 0x3fff), (1, 0x3fff), 1),
+                      ((1, 0x3fff), (0, 0x3fff), 0x200), ((1, 1), (0, 1), 3)]
+        for count in (artparser.VECTORIZED_STROKE_MIN_POINTS, 100, 2000):
+            for first in ((0.0, 0.0, 0.5), (-123.25, 4567.875, 1.0), (-0.0, -0.0, 0.0)):
+                deltas = [((int(sx), int(dx)), (int(sy), int(dy)), int(p)) for (sx, dx, sy, dy, p) in
+                          zip(rng.integers(0, 2, count), rng.integers(0, 0x4000, count),
+                              rng.integers(0, 2, count), rng.integers(0, 0x4000, count),
+                              rng.integers(0, 0x400, count))]
+                deltas = (edge_cases + deltas)[:count - 1]
+                data = b'\xff' * 3 + pack_stroke(first, deltas) + b'\xff'
+                with self.subTest(count=count, first=first):
+                    (vectorized, end) = artparser.read_stroke_points(data, 3, count)
+                    self.assertIsInstance(vectorized, np.ndarray)
+                    with mock.patch.object(artparser, 'VECTORIZED_STROKE_MIN_POINTS', count + 1):
+                        (loop, loop_end) = artparser.read_stroke_points(data, 3, count)
+                    self.assertIsInstance(loop, list)
+                    self.assertEqual(end, loop_end)
+                    self.assertEqual(end, len(data) - 1)
+                    self.assertEqual(vectorized.tolist(), loop)
+                    self.assertEqual(vectorized.tobytes(), np.array(loop).tobytes())
+
+
+@unittest.skipIf(artparser.np is None, 'point arrays require numpy')
+class PointArrayTest(unittest.TestCase):
+    def test_matches_dict_parse(self):
+        # the points are the same, rounded to float32
+        np = artparser.np
+        for fname in SAMPLE_FILES:
+            dicts = artparser.ArtParser(fname)
+            arrays = artparser.ArtParser(fname, point_arrays=True)
+            self.assertEqual(len(arrays.actions), len(dicts.actions))
+            for (i, (expected, action)) in enumerate(zip(dicts.actions, arrays.actions)):
+                with self.subTest(fname=os.path.basename(fname), action=i):
+                    self.assertEqual(set(action) - {'point_offset', 'point_count'}, set(expected))
+                    for key in expected:
+                        if key != 'points':
+                            self.assertEqual(action[key], expected[key])
+                    if 'points' not in expected:
+                        continue
+                    self.assertIsInstance(action['points'], artparser.PointList)
+                    rounded = np.array([(point['x'], point['y'], point['p'])
+                                        for point in expected['points']], dtype=np.float32)
+                    self.assertEqual(action['points'].array.reshape(-1, 3).tolist(),
+                                     rounded.reshape(-1, 3).tolist())
+                    self.assertEqual(list(action['points']), [
+                        {'x': x, 'y': y, 'p': p} for (x, y, p) in rounded.reshape(-1, 3).tolist()])
+
+    def test_repr_and_equality(self):
+        np = artparser.np
+        points = artparser.PointList(np.array([[1.0, 2.0, 0.5], [3.0, 4.0, 1.0]], dtype=np.float32))
+        self.assertEqual(repr(points), "PointList([{'x': 1.0, 'y': 2.0, 'p': 0.5}, "
+                                       "{'x': 3.0, 'y': 4.0, 'p': 1.0}])")
+        self.assertEqual(points, artparser.PointList(points.array.copy()))
+        self.assertNotEqual(points, points[:1])
+        self.assertNotEqual(points, list(points))
+        first = artparser.ArtParser(SAMPLE_FILES[-1], point_arrays=True)
+        second = artparser.ArtParser(SAMPLE_FILES[-1], point_arrays=True)
+        self.assertEqual(first.actions, second.actions)
+
+
+def without_offsets(actions):
+    '''
+    Returns copies of the actions without point_offset, which is relative
+    to the points of the whole document or of the single action.
+    '''
+    return [{key: value for (key, value) in action.items() if key != 'point_offset'}
+            for action in actions]
+
+
+class StreamActionsTest(unittest.TestCase):
+    def test_matches_full_parse(self):
+        # small chunks, so that records are split across them
+        def small_chunks(payload, chunk_size=0x10000, window=None, progress=None):
+            return stream(payload, 0x40, window, progress)
+        stream = artparser.mischief_unpack_stream
+        for fname in SAMPLE_FILES:
+            for point_arrays in (False, True):
+                with self.subTest(fname=os.path.basename(fname), point_arrays=point_arrays):
+                    full = artparser.ArtParser(fname, point_arrays=point_arrays)
+                    for patched in (False, True):
+                        with mock.patch.object(artparser, 'mischief_unpack_stream',
+                                               small_chunks if patched else stream):
+                            art = artparser.ArtParser(fname, stream_actions=True,
+                                                      point_arrays=point_arrays)
+                            self.assertIsNone(art.actions)
+                            self.assertEqual((art.layers, art.pins, art.action_count),
+                                             (full.layers, full.pins, full.action_count))
+                            actions = list(art.iter_actions())
+                        self.assertEqual(without_offsets(actions), without_offsets(full.actions))
+                        self.assertEqual(art.unknown_eof, full.unknown_eof)
+                        with self.assertRaisesRegex(Exception, 'already been iterated'):
+                            next(art.iter_actions())
+
+    def test_close_before_end(self):
+        art = artparser.ArtParser(SAMPLE_FILES[-1], stream_actions=True)
+        actions = art.iter_actions()
+        self.assertEqual(next(actions), artparser.ArtParser(SAMPLE_FILES[-1]).actions[0])
+        actions.close()
+        self.assertIsNone(art.reader)
+        self.assertIsNone(art.payload)
+
+
+class LazyActionsTest(unittest.TestCase):
+    def test_matches_full_parse(self):
+        for fname in SAMPLE_FILES:
+            for point_arrays in (False, True):
+                with self.subTest(fname=os.path.basename(fname), point_arrays=point_arrays):
+                    full = artparser.ArtParser(fname, point_arrays=point_arrays)
+                    art = artparser.ArtParser(fname, lazy_actions=True, point_arrays=point_arrays)
+                    self.assertIsInstance(art.actions, artparser.LazyActions)
+                    self.assertEqual(len(art.actions), len(full.actions))
+                    expected = without_offsets(full.actions)
+                    self.assertEqual(without_offsets(art.actions), expected)
+                    self.assertEqual(without_offsets(art.iter_actions()), expected)
+                    # random access, from both ends and by slices
+                    for i in (0, len(expected) // 2, -1):
+                        self.assertEqual(without_offsets([art.actions[i]]), [expected[i]])
+                    self.assertEqual(without_offsets(art.actions[1::3]), expected[1::3])
+                    self.assertEqual(art.unknown_eof, full.unknown_eof)
+                    with self.assertRaises(IndexError):
+                        art.actions[len(expected)]
+
+
+class LayerIndexTest(unittest.TestCase):
+    def test_actions_for_layers(self):
+        for fname in SAMPLE_FILES:
+            for lazy in (False, True):
+                art = artparser.ArtParser(fname, lazy_actions=lazy)
+                actions = list(art.actions)
+                for layers in ([0], [1], [2, 0], [1, 1], [5], []):
+                    for pen_state in (False, True):
+                        with self.subTest(fname=os.path.basename(fname), lazy=lazy,
+                                          layers=layers, pen_state=pen_state):
+                            # the same actions as filtering all of them, in file order
+                            expected = [action for action in actions if action['layer'] in layers or
+                                        pen_state and action['action_id'] in artparser.PEN_STATE_ACTION_IDS]
+                            self.assertEqual(list(art.actions_for_layers(layers, pen_state)), expected)
+
+    def test_no_index_for_streamed_actions(self):
+        art = artparser.ArtParser(SAMPLE_FILES[-1], stream_actions=True)
+        self.addCleanup(art.close)
+        with self.assertRaisesRegex(Exception, 'no layer index'):
+            next(art.actions_for_layers([0]))
+
+
+class ProbeTest(unittest.TestCase):
+    METADATA = ('version', 'active_layer_num', 'background_color', 'background_alpha',
+                'pen_info', 'view_matrix', 'view_zoom', 'layer_order', 'layers', 'pins')
+
+    def test_matches_full_parse(self):
+        for fname in SAMPLE_FILES:
+            full = artparser.ArtParser(fname)
+            for images in (False, True):
+                with self.subTest(fname=os.path.basename(fname), images=images):
+                    art = artparser.ArtParser.probe(fname, images)
+                    names = self.METADATA + (('images', 'action_count') if images else ())
+                    for name in names:
+                        self.assertEqual(getattr(art, name), getattr(full, name), name)
+                    # nothing else is parsed, and nothing more than in a full parse
+                    if not images:
+                        self.assertEqual((art.images, art.action_count), (None, None))
+                    self.assertIsNone(art.actions)
+                    for (name, value) in vars(art).items():
+                        if name != 'probed':
+                            self.assertEqual(value, getattr(full, name), name)
+
+    def test_no_actions(self):
+        art = artparser.ArtParser.probe(SAMPLE_FILES[-1], images=True)
+        with self.assertRaisesRegex(Exception, 'created by probe'):
+            next(art.iter_actions())
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelTest(unittest.TestCase):
+    # the sample payloads are smaller than a piece
+    PIECE_SIZE = 0x100
+
+    def setUp(self):
+        patcher = mock.patch.object(artparser, 'STEP_PIECE_SIZE', self.PIECE_SIZE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fname = SAMPLE_FILES[-1]
+        self.payload = read_payload(self.fname)
+        self.expected = bytes(artparser.mischief_unpack(self.payload))
+        self.assertGreater(len(self.expected), 8 * self.PIECE_SIZE)
+
+    def cancel_after(self, count, calls):
+        def progress(done, total):
+            calls.append((done, total))
+            if len(calls) == count:
+                raise Cancelled()
+        return progress
+
+    def test_progress_reports_pieces(self):
+        calls = []
+        artparser.ArtParser(self.fname, progress=lambda *args: calls.append(args))
+        total = len(self.expected)
+        self.assertGreater(len(calls), 8)
+        self.assertEqual(calls[-1], (total, total))
+        for ((before, _), (after, _)) in zip(calls, calls[1:-1]):
+            self.assertGreaterEqual(after - before, self.PIECE_SIZE)
+
+    def test_progress_cancels_parse(self):
+        for options in ({}, {'lazy_actions': True}, {'point_arrays': True}):
+            with self.subTest(**options):
+                calls = []
+                with self.assertRaises(Cancelled):
+                    artparser.ArtParser(self.fname, progress=self.cancel_after(3, calls), **options)
+                self.assertEqual(len(calls), 3)
+                self.assertLess(calls[-1][0], calls[-1][1])
+
+    def test_progress_cancels_streamed_actions(self):
+        # small chunks, so that the actions are decompressed as they are read
+        def small_chunks(payload, chunk_size=0x10000, window=None, progress=None):
+            return stream(payload, self.PIECE_SIZE, window, progress)
+        stream = artparser.mischief_unpack_stream
+        calls = []
+        limit = [None]
+        def progress(done, total):
+            calls.append(done)
+            if len(calls) == limit[0]:
+                raise Cancelled()
+        with mock.patch.object(artparser, 'mischief_unpack_stream', small_chunks):
+            art = artparser.ArtParser(self.fname, stream_actions=True, progress=progress)
+        limit[0] = len(calls) + 3
+        actions = []
+        with self.assertRaises(Cancelled):
+            for action in art.iter_actions():
+                actions.append(action)
+        self.assertEqual(len(calls), limit[0])
+        self.assertGreater(len(actions), 0)
+        self.assertLess(len(actions), art.action_count)
+        # the input is released and the stream is not picked up again
+        self.assertIsNone(art.payload)
+        with self.assertRaisesRegex(Exception, 'already been iterated'):
+            next(art.iter_actions())
+
+    def test_deadline_stops_and_resumes(self):
+        unpacker = artparser.MischiefUnpacker(self.payload)
+        # a deadline that has passed stops before decoding anything
+        self.assertFalse(unpacker.step(deadline=time.monotonic()))
+        self.assertEqual(unpacker.output.get_length(), 0)
+        # the clock is checked before each piece, each of which may end
+        # in a copy past the piece size
+        with mock.patch.object(artparser.time, 'monotonic', side_effect=range(100)) as clock:
+            self.assertFalse(unpacker.step(deadline=3))
+        self.assertEqual(clock.call_count, 4)
+        length = unpacker.output.get_length()
+        self.assertGreaterEqual(length, 3 * self.PIECE_SIZE)
+        self.assertLess(length, 3 * (self.PIECE_SIZE + 272))
+        self.assertEqual(bytes(unpacker.output.get_data()), self.expected[:length])
+        self.assertTrue(unpacker.step(deadline=time.monotonic() + 60))
+        self.assertEqual(bytes(unpacker.output.get_data()), self.expected)
+
+
+class LoadAsyncTest(unittest.TestCase):
+    def test_cancel_keeps_slot_until_chunk_done(self):
+        # a cancelled load holds on to its semaphore slot until the chunk
+        # running on the worker thread is done
+        lock = threading.Lock()
+        (started, finish) = (threading.Event(), threading.Event())
+        counts = {'running': 0, 'peak': 0}
+        step = artparser.MischiefUnpacker.step
+
+        def blocking_step(unpacker, *args):
+            with lock:
+                counts['running'] += 1
+                counts['peak'] = max(counts['peak'], counts['running'])
+            started.set()
+            finish.wait(5)
+            try:
+                return step(unpacker, *args)
+            finally:
+                with lock:
+                    counts['running'] -= 1
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            semaphore = asyncio.Semaphore(1)
+            first = asyncio.ensure_future(artparser.ArtParser.load_async(
+                SAMPLE_FILES[-1], semaphore=semaphore, chunk_size=0x100))
+            await loop.run_in_executor(None, started.wait, 5)
+            first.cancel()
+            second = asyncio.ensure_future(artparser.ArtParser.load_async(
+                SAMPLE_FILES[-1], semaphore=semaphore, chunk_size=0x100))
+            await asyncio.sleep(0.1)
+            finish.set()
+            art = await second
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            return art
+
+        with mock.patch.object(artparser.MischiefUnpacker, 'step', blocking_step):
+            art = asyncio.run(run())
+        self.assertEqual(counts['peak'], 1)
+        self.assertEqual(bytes(art.data), bytes(artparser.ArtParser(SAMPLE_FILES[-1]).data))
+
+
+def rdp_reference(points, tolerance):
+    '''
+    Recursive Ramer-Douglas-Peucker on a list of (x, y), with the
+    distances taken to the chord as a segment. Returns the indices of the
+    kept points.
+    '''
+    def distance(point, a, b):
+        (cx, cy) = (b[0] - a[0], b[1] - a[1])
+        (px, py) = (point[0] - a[0], point[1] - a[1])
+        length2 = cx * cx + cy * cy
+        if length2 > 0:
+            t = min(max((px * cx + py * cy) / length2, 0.0), 1.0)
+            (px, py) = (px - t * cx, py - t * cy)
+        return (px * px + py * py) ** 0.5
+
+    def simplify(first, last):
+        if last - first < 2:
+            return [first]
+        distances = [distance(points[i], points[first], points[last])
+                     for i in range(first + 1, last)]
+        middle = first + 1 + distances.index(max(distances))
+        if distances[middle - first - 1] <= tolerance:
+            return [first]
+        return simplify(first, middle) + simplify(middle, last)
+
+    if len(points) < 2:
+        return list(range(len(points)))
+    return simplify(0, len(points) - 1) + [len(points) - 1]
+
+
+@unittest.skipIf(artparser.np is None, 'simplification requires numpy')
+class SimplifyTest(unittest.TestCase):
+    def test_matches_recursive_reference(self):
+        np = artparser.np
+        rng = np.random.default_rng(3)
+        for count in (0, 1, 2, 3, 10, artparser.RDP_VECTORIZED_MIN_POINTS + 2, 500):
+            for tolerance in (0.0, 0.5, 2.0, 20.0):
+                with self.subTest(count=count, tolerance=tolerance):
+                    # a random walk, like a stroke
+                    xy = np.cumsum(rng.normal(0, 3, (count, 2)), axis=0)
+                    expected = rdp_reference(xy.tolist(), tolerance)
+                    self.assertEqual(np.flatnonzero(artparser.rdp_mask(xy, tolerance)).tolist(),
+                                     expected)
+
+    def test_tolerance_boundary(self):
+        # points exactly at the tolerance are dropped, further ones kept
+        np = artparser.np
+        xy = np.array([[0.0, 0.0], [2.0, 1.0], [4.0, 0.0]])
+        self.assertEqual(artparser.rdp_mask(xy, 1.0).tolist(), [True, False, True])
+        self.assertEqual(artparser.rdp_mask(xy, 0.999).tolist(), [True, True, True])
+        # beyond the ends of the chord, the distance is to the nearest end
+        xy = np.array([[0.0, 0.0], [-1.0, 0.0], [4.0, 0.0]])
+        self.assertEqual(artparser.rdp_mask(xy, 1.0).tolist(), [True, False, True])
+        self.assertEqual(artparser.rdp_mask(xy, 0.5).tolist(), [True, True, True])
+
+    def test_kept_points_keep_pressure(self):
+        np = artparser.np
+        rng = np.random.default_rng(4)
+        xyp = np.column_stack((np.cumsum(rng.normal(0, 3, (200, 2)), axis=0),
+                               rng.uniform(0, 1, 200))).astype(np.float32)
+        mask = artparser.rdp_mask(xyp[:, :2].astype(np.float64), 2.0)
+        self.assertLess(mask.sum(), 200)
+        expected = xyp[mask]
+        self.assertEqual(artparser.simplify_points(xyp, 2.0).tolist(), expected.tolist())
+        self.assertEqual(artparser.simplify_points(artparser.PointList(xyp), 2.0).array.tolist(),
+                         expected.tolist())
+        dicts = [{'x': x, 'y': y, 'p': p} for (x, y, p) in xyp.tolist()]
+        self.assertEqual([(point['x'], point['y'], point['p'])
+                          for point in artparser.simplify_points(dicts, 2.0)],
+                         [tuple(point) for point in expected.tolist()])
+
+
+@unittest.skipIf(artparser.np is None, 'the spatial index requires numpy')
+class SpatialIndexTest(unittest.TestCase):
+    @staticmethod
+    def brute_force(boxes, rect):
+        np = artparser.np
+        (xmin, ymin, xmax, ymax) = rect
+        return np.flatnonzero((boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) &
+                              (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin))
+
+    def random_rects(self, rng, low, high, count=100):
+        for _ in range(count):
+            center = rng.uniform(low, high)
+            size = rng.uniform(0, (high - low).max() / 2, 2)
+            yield tuple(center - size) + tuple(center + size)
+
+    def test_query_matches_brute_force(self):
+        np = artparser.np
+        rng = np.random.default_rng(1)
+        for count in (0, 1, 15, 16, 17, 300, 5000):
+            corners = rng.uniform(-1000, 1000, (count, 2))
+            boxes = np.column_stack((corners, corners + rng.uniform(0, 100, (count, 2))))
+            layers = rng.integers(0, 3, count)
+            index = artparser.SpatialIndex(boxes, np.arange(count), layers)
+            for rect in self.random_rects(rng, np.array([-1100, -1100]), np.array([1100, 1100])):
+                with self.subTest(count=count, rect=rect):
+                    expected = self.brute_force(boxes, rect)
+                    self.assertEqual(np.sort(index.query(rect)).tolist(), expected.tolist())
+                    on_layer = expected[layers[expected] == 1]
+                    self.assertEqual(np.sort(index.query(rect, [1])).tolist(), on_layer.tolist())
+
+    def test_parser_query(self):
+        np = artparser.np
+        rng = np.random.default_rng(2)
+        for fname in SAMPLE_FILES:
+            for kwargs in ({}, {'point_arrays': True}, {'lazy_actions': True}):
+                art = artparser.ArtParser(fname, **kwargs)
+                art.compute_bboxes()
+                boxes = art.action_bboxes
+                if np.isnan(boxes[:, 0]).all():
+                    continue
+                (low, high) = (np.nanmin(boxes[:, :2], axis=0), np.nanmax(boxes[:, 2:], axis=0))
+                for rect in self.random_rects(rng, low, high, 20):
+                    with self.subTest(fname=os.path.basename(fname), kwargs=kwargs, rect=rect):
+                        self.assertEqual(art.query(rect).tolist(),
+                                         self.brute_force(boxes, rect).tolist())
+
+    def test_boxes_contain_transformed_points(self):
+        # the points of strokes and polylines, grown by half the pen width
+        # and transformed by the layer and pen matrices like the exporters
+        # do, lie within their boxes
+        np = artparser.np
+        for fname in SAMPLE_FILES:
+            art = artparser.ArtParser(fname)
+            art.compute_bboxes()
+            matrix = np.eye(4)
+            radius = 0.5
+            for (i, action) in enumerate(art.actions):
+                if action['action_id'] == 51:
+                    matrix = np.asarray(art.layers[action['layer']]['matrix']) @ np.asarray(action['matrix'])
+                if action['action_id'] == 0x34:
+                    radius = abs(action['size']) / 2.0
+                if not action.get('points'):
+                    continue
+                with self.subTest(fname=os.path.basename(fname), action=i):
+                    xy = np.array([(point['x'] + dx, point['y'] + dy, 0.0, 1.0)
+                                   for point in action['points']
+                                   for (dx, dy) in ((-radius, -radius), (-radius, radius),
+                                                    (radius, -radius), (radius, radius))]) @ matrix
+                    xy = xy[:, :2] / xy[:, 3:]
+                    (xmin, ymin, xmax, ymax) = art.action_bboxes[i]
+                    self.assertTrue((xy[:, 0] >= xmin - 1e-6).all() and (xy[:, 0] <= xmax + 1e-6).all())
+                    self.assertTrue((xy[:, 1] >= ymin - 1e-6).all() and (xy[:, 1] <= ymax + 1e-6).all())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import io
+import os
+import struct
+import sys
+import unittest
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import artparser
+
+try:
+    import strokes2png
+except ImportError:
+    strokes2png = None
+
+from test_artparser import SAMPLE_FILES
+
+WIDTH = 160
+
+
+def read_png(data):
+    '''
+    Checks the structure of a PNG written by writePng and returns its
+    width, height and rows (each starting with its filter byte).
+    '''
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError('bad signature')
+    (pos, chunks) = (8, [])
+    while pos < len(data):
+        (length,) = struct.unpack_from('>I', data, pos)
+        kind = data[pos+4:pos+8]
+        body = data[pos+8:pos+8+length]
+        (crc,) = struct.unpack_from('>I', data, pos + 8 + length)
+        if crc != zlib.crc32(kind + body):
+            raise ValueError('bad CRC in ' + repr(kind))
+        chunks.append((kind, body))
+        pos += 12 + length
+    if [kind for (kind, _) in chunks] != [b'IHDR', b'IDAT', b'IEND']:
+        raise ValueError('unexpected chunks')
+    (width, height, depth, color, compression, filtering, interlace) = \
+        struct.unpack('>IIBBBBB', chunks[0][1])
+    if (depth, color, compression, filtering, interlace) != (8, 6, 0, 0, 0):
+        raise ValueError('unexpected format')
+    return (width, height, zlib.decompress(chunks[1][1]))
+
+
+@unittest.skipIf(strokes2png is None, 'strokes2png requires numpy')
+class RenderTest(unittest.TestCase):
+    def export(self, art, tile_size, workers):
+        out = io.BytesIO()
+        strokes2png.exportPng(art, out, WIDTH, tileSize=tile_size, workers=workers)
+        return out.getvalue()
+
+    def test_same_output_for_any_tiling(self):
+        for fname in SAMPLE_FILES:
+            art = artparser.ArtParser(fname, point_arrays=True)
+            expected = self.export(art, WIDTH * 4, 1)
+            for (tile_size, workers) in ((64, 1), (37, 1), (64, 2), (16, 3)):
+                with self.subTest(fname=os.path.basename(fname), tile_size=tile_size,
+                                  workers=workers):
+                    self.assertEqual(self.export(art, tile_size, workers), expected)
+
+    def test_valid_png(self):
+        np = artparser.np
+        for fname in SAMPLE_FILES:
+            with self.subTest(fname=os.path.basename(fname)):
+                art = artparser.ArtParser(fname, point_arrays=True)
+                scene = strokes2png.buildScene(art, WIDTH)
+                image = strokes2png.renderScene(scene, workers=1)
+                out = io.BytesIO()
+                strokes2png.writePng(out, image)
+                (width, height, rows) = read_png(out.getvalue())
+                self.assertEqual((width, height), (scene.width, scene.height))
+                rows = np.frombuffer(rows, dtype=np.uint8).reshape(height, width * 4 + 1)
+                self.assertFalse(rows[:, 0].any())
+                self.assertEqual(rows[:, 1:].tobytes(), image.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
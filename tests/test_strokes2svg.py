@@ -0,0 +1,257 @@
+import contextlib
+import io
+import os
+import re
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import artparser
+
+try:
+    import strokes2svg
+except ImportError:
+    strokes2svg = None
+
+from test_artparser import SAMPLE_FILES
+
+
+# the properties that children inherit from their group
+INHERITED = ('fill', 'stroke', 'stroke-width', 'stroke-opacity', 'stroke-linejoin',
+             'stroke-linecap', 'opacity', 'visibility')
+SHAPES = ('polyline', 'path', 'rect', 'ellipse')
+
+
+def declarations(css):
+    return dict(tuple(part.strip() for part in item.split(':', 1))
+                for item in css.split(';') if item.strip())
+
+
+def transform_functions(transform):
+    # units are dropped, as SVG attributes give the same values without them
+    return [(name, tuple(float(value) for value in re.findall(r'[-+]?[0-9.]+(?:e[-+]?[0-9]+)?', args)))
+            for (name, args) in re.findall(r'([a-zA-Z0-9]+)\(([^)]*)\)', transform)]
+
+
+def drawn_shapes(svg):
+    '''
+    Returns the shapes of an SVG written by SvgExporter, in document order,
+    each with its geometry attributes, the properties it inherits or sets,
+    and all the transforms applied to it with their origins. Shapes drawn
+    the same way give the same results whether their styles are inline
+    or in classes.
+    '''
+    root = ET.fromstring(svg)
+    ns = '{http://www.w3.org/2000/svg}'
+    classes = {}
+    for style in root.iter(ns + 'style'):
+        for (name, css) in re.findall(r'\.(\w+) \{([^}]*)\}', style.text):
+            classes[name] = declarations(css)
+    shapes = []
+    def visit(element, inherited, transforms):
+        css = dict(classes.get(element.get('class'), {}))
+        css.update(declarations(element.get('style', '')))
+        for name in INHERITED:
+            value = css.get(name, element.get(name))
+            if value is not None:
+                inherited = dict(inherited, **{name: value})
+        # a transform in the CSS replaces the transform attribute
+        transform = css.get('transform', element.get('transform'))
+        if transform is not None:
+            origin = css.get('transform-origin', element.get('transform-origin', '0 0'))
+            transforms = transforms + [(origin, function)
+                                       for function in transform_functions(transform)]
+        tag = element.tag[len(ns):]
+        if tag in SHAPES:
+            geometry = {key: value for (key, value) in element.attrib.items()
+                        if key not in ('style', 'class', 'transform')}
+            shapes.append((tag, geometry, inherited, transforms))
+        for child in element:
+            visit(child, inherited, transforms)
+    visit(root, {}, [])
+    return shapes
+
+
+@unittest.skipIf(strokes2svg is None, 'strokes2svg requires numpy')
+class SvgExporterTest(unittest.TestCase):
+    def dropped_strokes(self, art, **kwargs):
+        exporter = strokes2svg.SvgExporter(art, io.StringIO(), **kwargs)
+        try:
+            dropped = []
+            for (i, action) in enumerate(art.iter_actions()):
+                exporter.feed(action)
+                if exporter.strokeDropped:
+                    dropped.append(i)
+            return dropped
+        finally:
+            exporter.close()
+
+    def test_path_data_keeps_dots(self):
+        # strokes that round to a single point still draw a dot
+        np = artparser.np
+        self.assertEqual(strokes2svg.pathData(np.array([[1.5, 1.0]]), 2), 'M1.5 1l0 0')
+        self.assertEqual(strokes2svg.pathData(np.array([[1.0, 1.0]] * 3), 2), 'M1 1l0 0')
+        self.assertEqual(strokes2svg.pathData(np.array([[1.0, 1.0], [1.001, 1.0]]), 2), 'M1 1l0 0')
+        self.assertEqual(strokes2svg.pathData(np.array([[1.0, 1.0], [1.0, 1.0], [2.0, 1.0]]), 2),
+                         'M1 1l1 0')
+
+    def test_pretransform_applies_matrices(self):
+        # the written points are the stroke points multiplied by the layer
+        # and pen matrix, as matrix3d would draw them
+        np = artparser.np
+        checked = 0
+        for fname in SAMPLE_FILES:
+            art = artparser.ArtParser(fname)
+            exporter = strokes2svg.SvgExporter(art, io.StringIO(), pretransform=True)
+            expected = [[] for layer in art.layers]
+            matrix = np.eye(4)
+            try:
+                for action in art.iter_actions():
+                    exporter.feed(action)
+                    if action['action_id'] == 51:
+                        matrix = np.asarray(art.layers[action['layer']]['matrix']) @ \
+                            np.asarray(action['matrix'])
+                    if action.get('points') is None:
+                        continue
+                    xyzw = np.array([(point['x'], point['y'], 0.0, 1.0)
+                                     for point in action['points']]).reshape(-1, 4) @ matrix
+                    # perspective matrices are still written as matrix3d
+                    if exporter.affine is not None:
+                        expected[action['layer']].append((xyzw[:, :2] / xyzw[:, 3:],
+                                                          np.allclose(matrix, np.eye(4))))
+                    else:
+                        expected[action['layer']].append((None, False))
+                for (layer, strokes) in enumerate(expected):
+                    exporter.layerCode[layer].seek(0)
+                    code = exporter.layerCode[layer].read()
+                    elements = re.findall(r'<polyline ([^>]*)points="([^"]*)"', code)
+                    self.assertEqual(len(elements), len(strokes))
+                    for ((style, points), (xy, identity)) in zip(elements, strokes):
+                        if xy is None:
+                            self.assertIn('matrix3d', style)
+                            continue
+                        with self.subTest(fname=os.path.basename(fname), layer=layer, checked=checked):
+                            self.assertNotIn('matrix3d', style)
+                            written = np.array([point.split(',') for point in points.split()],
+                                               dtype=np.float64).reshape(-1, 2)
+                            np.testing.assert_allclose(written, xy, rtol=1e-9, atol=1e-9)
+                            checked += not identity
+            finally:
+                exporter.close()
+        self.assertGreater(checked, 10)
+
+    def test_min_size_ignores_pretransform(self):
+        for fname in SAMPLE_FILES:
+            art = artparser.ArtParser(fname, point_arrays=True)
+            for min_size in (1.0, 40.0):
+                with self.subTest(fname=os.path.basename(fname), min_size=min_size):
+                    self.assertEqual(self.dropped_strokes(art, minSize=min_size, pretransform=True),
+                                     self.dropped_strokes(art, minSize=min_size))
+
+    def test_layer_filter(self):
+        # a filtered SVG has the groups of the requested layers, as they
+        # are in the SVG of all layers
+        group = re.compile(r'^\t<g id="([^"]*)".*?^\t</g>\n', re.M | re.S)
+        for fname in SAMPLE_FILES:
+            art = artparser.ArtParser(fname)
+            full = {match.group(1): match.group(0)
+                    for match in group.finditer(strokes2svg.buildSvg(art))}
+            self.assertEqual(len(full), len(art.layers))
+            for layers in ([0], [1], [2, 0]):
+                with self.subTest(fname=os.path.basename(fname), layers=layers):
+                    svg = strokes2svg.buildSvg(art, layers=layers)
+                    groups = [(match.group(1), match.group(0)) for match in group.finditer(svg)]
+                    names = {art.layers[layer]['name'] for layer in layers if layer < len(art.layers)}
+                    self.assertEqual({name for (name, _) in groups}, names)
+                    for (name, code) in groups:
+                        self.assertEqual(code, full[name])
+                    self.assertEqual(len(svg) - sum(len(code) for (_, code) in groups),
+                                     len(strokes2svg.buildSvg(art, layers=[])))
+
+    def run_main(self, *args):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            strokes2svg.main(['strokes2svg.py'] + list(args))
+        return out.getvalue()
+
+    def test_streamed_output_matches_buffered(self):
+        for fname in SAMPLE_FILES:
+            for options in ([], ['--precision', '2'], ['--share-styles', '--pretransform'],
+                            ['--simplify', '0.5', '--precision', '3']):
+                with self.subTest(fname=os.path.basename(fname), options=options):
+                    expected = self.run_main(fname, *options)
+                    self.assertTrue(expected.endswith('</svg>\n'))
+                    self.assertEqual(self.run_main(fname, '--stream', *options), expected)
+                    # with the code of the layers spilled to disk
+                    with mock.patch.object(strokes2svg, 'LAYER_SPOOL_SIZE', 16):
+                        self.assertEqual(self.run_main(fname, '--stream', *options), expected)
+
+    def test_streamed_levels_match_buffered(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for fname in SAMPLE_FILES:
+                with self.subTest(fname=os.path.basename(fname)):
+                    outputs = []
+                    for stream_actions in (False, True):
+                        art = artparser.ArtParser(fname, stream_actions=stream_actions,
+                                                  point_arrays=True)
+                        paths = [os.path.join(directory, '%d_%d.svg' % (stream_actions, level))
+                                 for level in range(len(strokes2svg.LEVEL_SCALES))]
+                        outs = [open(path, 'w') for path in paths]
+                        try:
+                            strokes2svg.exportSvgLevels(art, outs, precision=2)
+                        finally:
+                            for out in outs:
+                                out.close()
+                            art.close()
+                        contents = []
+                        for path in paths:
+                            with open(path) as file:
+                                contents.append(file.read())
+                        outputs.append(contents)
+                    self.assertEqual(outputs[1], outputs[0])
+                    self.assertEqual(outputs[0][0],
+                                     strokes2svg.buildSvg(artparser.ArtParser(fname, point_arrays=True),
+                                                          precision=2, simplify=0.5))
+
+    def test_shared_styles_draw_the_same(self):
+        checked = set()
+        for fname in SAMPLE_FILES:
+            art = artparser.ArtParser(fname, point_arrays=True)
+            for (precision, pretransform) in ((None, False), (2, False), (None, True)):
+                with self.subTest(fname=os.path.basename(fname), precision=precision,
+                                  pretransform=pretransform):
+                    inline = strokes2svg.buildSvg(art, precision=precision,
+                                                  pretransform=pretransform)
+                    shared = strokes2svg.buildSvg(art, precision=precision, shareStyles=True,
+                                                  pretransform=pretransform)
+                    expected = drawn_shapes(inline)
+                    # all but the background take their style from a class
+                    lines = re.findall(r'^\t\t<(?:%s) .*$' % '|'.join(SHAPES), shared, re.M)
+                    self.assertEqual(len(lines), len(expected) - ('mischiefBg' in shared))
+                    for line in lines:
+                        self.assertNotIn('style=', line)
+                    self.assertEqual(drawn_shapes(shared), expected)
+                    checked.update(tag for (tag, _, _, _) in expected)
+        self.assertEqual(checked, {'polyline', 'path', 'rect', 'ellipse'})
+
+    def test_levels_reject_simplify(self):
+        with tempfile.TemporaryDirectory() as directory:
+            prefix = os.path.join(directory, 'out')
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                with self.assertRaises(SystemExit) as raised:
+                    strokes2svg.main(['strokes2svg.py', SAMPLE_FILES[-1], '--levels', prefix,
+                                      '--simplify', '0.5'])
+            self.assertEqual(raised.exception.code, 2)
+            self.assertIn('--simplify cannot be used with --levels', err.getvalue())
+            self.assertEqual(os.listdir(directory), [])
+            strokes2svg.main(['strokes2svg.py', SAMPLE_FILES[-1], '--levels', prefix])
+            self.assertEqual(len(os.listdir(directory)), len(strokes2svg.LEVEL_SCALES))
+
+
+if __name__ == '__main__':
+    unittest.main()